@@ -2,10 +2,11 @@ from argparse import ArgumentParser
 import asyncio
 from dataclasses import dataclass, field
 import logging
+from math import ceil, inf
 from os.path import dirname, isdir
 from secrets import token_urlsafe
 from sys import stderr
-from typing import cast
+from typing import Any, Callable, Hashable, Iterable, TypeVar, cast
 
 from aiohttp.client_exceptions import ClientError
 from fastapi import FastAPI, HTTPException, WebSocket
@@ -21,11 +22,17 @@ from tomlconfig import ConfigError, parse
 import uvicorn
 
 from .config import Config
+from .data.base import COVCallback
 from .data.controller import DataController
+from .data.poller import DataPoller
+from .protocol import BINARY_SUBPROTOCOL, MAX_HANDLES, encode_deltas
 from .scheme.controller import SchemesController
+from .sender import SenderStats, Value, WebSocketSender
 
 _logger = logging.getLogger(__name__)
 
+_K = TypeVar("_K", bound=Hashable)
+
 parser = ArgumentParser("Visu")
 parser.add_argument("--debug", help="show debug output on stderr",
                     action="store_true", default=False)
@@ -55,7 +62,17 @@ _logger.setLevel(logging.DEBUG if visu_config.debug else logging.INFO)
 
 
 data_controller = DataController(visu_config)
+data_poller = DataPoller(data_controller)
 schemes_controller = SchemesController(visu_config)
+sender_stats = SenderStats()
+for scheme in schemes_controller.get_schemes():
+    for element in scheme.element:
+        data_controller.compile_data_ids(element.data_module,
+                                         (element.data_id,))
+        if element.max_age is not None:
+            data_controller.cache.set_max_age(element.data_module,
+                                              element.data_id,
+                                              element.max_age)
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory=f"{dirname(__file__)}/static"),
@@ -70,6 +87,7 @@ async def startup_event() -> None:
 
 @app.on_event("shutdown")
 async def shutdown_event() -> None:
+    await data_poller.stop()
     await data_controller.stop()
 
 
@@ -90,72 +108,267 @@ async def set_data(module: str, data: dict[str, str]) \
     return await data_controller.set_values(module, data)
 
 
+@app.get("/stats")
+async def get_stats() -> dict[str, dict[str, object]]:
+    stats = data_controller.get_stats()
+    stats["poller"] = dict(data_poller.get_stats())
+    stats["websocket"] = dict(sender_stats.get_stats())
+    return stats
+
+
 @dataclass
 class WSMessage:
     command: str = ""
+    data_module: str = ""
     data_ids: list[str] = field(default_factory=list)
     data: dict[str, str] = field(default_factory=dict)
+    handles: list[int] = field(default_factory=list)
+    interval: int = 0
+    single: bool = False
+
+
+def _create_sender(websocket: WebSocket,
+                   format_values: Callable[[dict[_K, Value]],
+                                           Iterable[dict[str, Any] | bytes]]) \
+        -> WebSocketSender[_K]:
+    return WebSocketSender(websocket, sender_stats, format_values,
+                           visu_config.websocket.send_timeout,
+                           visu_config.websocket.max_messages)
 
 
 @app.websocket("/ws/{module}")
 async def data_websocket(websocket: WebSocket, module: str) -> None:
     await websocket.accept()
+    sender: WebSocketSender[str] = _create_sender(
+        websocket, lambda values: (values,),
+    )
+    sender.start()
     callbacks: list[tuple[str, str]] = []
+    polls: set[str] = set()
+    poll_id = token_urlsafe(16)
+
+    async def callback(data_id: str, value: str | list[str]) -> None:
+        sender.put_values({data_id: value})
+
     try:
         while True:
-            data = await websocket.receive_json()
+            data = await sender.receive_json()
             try:
                 message = WSMessage(**data)
                 if message.command == "get":
-                    await websocket.send_json(
-                        await data_controller.get_values(module,
-                                                         message.data_ids),
-                    )
+                    sender.put_values(await data_controller.get_values(
+                        module, message.data_ids,
+                    ))
                 elif message.command == "set":
-                    await websocket.send_json(
-                        await data_controller.set_values(module, message.data),
-                    )
+                    sender.put_values(await data_controller.set_values(
+                        module, message.data,
+                    ))
+                elif message.command == "poll":
+                    if not isinstance(message.interval, (int, float)) \
+                            or not 0 < message.interval < inf:
+                        raise HTTPException(400, "Invalid interval")
+                    interval = max(ceil(message.interval),
+                                   visu_config.websocket.min_poll_interval, 1)
+                    for data_id in message.data_ids:
+                        polls.add(data_id)
+                        await data_poller.subscribe(module, data_id, poll_id,
+                                                    interval, callback,
+                                                    message.single)
+                    sender.put_message({
+                        "status": 200,
+                        "detail": "Polling",
+                    })
                 elif message.command == "cov":
                     for data_id in message.data_ids:
                         callback_id = token_urlsafe(16)
-                        async def callback(data_id: str,
-                                           value: str | list[str]) -> None:
-                            await websocket.send_json({data_id: value})
                         callbacks.append((data_id, callback_id))
                         if await data_controller.register_cov(module, data_id,
                                                               callback_id,
                                                               callback):
-                            await websocket.send_json({
+                            sender.put_message({
                                 "status": 200,
                                 "detail": "Subsribed",
                             })
                         else:
-                            await websocket.send_json({
+                            sender.put_message({
                                 "status": 403,
-                                "detail": "Module does not support COV messages",
+                                "detail": "Module does not support COV "
+                                "messages",
                             })
                 else:
-                    await websocket.send_json({
+                    sender.put_message({
                         "status": 400,
                         "detail": f"Invalid command '{message.command}'",
                     })
             except HTTPException as ex:
-                await websocket.send_json({
+                sender.put_message({
                     "status": ex.status_code,
                     "detail": ex.detail,
                 })
             except TypeError:
-                await websocket.send_json({
+                sender.put_message({
                     "status": 400,
                     "detail": "Invalid message",
                 })
     except WebSocketDisconnect:
         pass
     finally:
+        await sender.stop()
+        for data_id in polls:
+            await data_poller.unsubscribe(module, data_id, poll_id)
         for data_id, callback_id in callbacks:
             await data_controller.remove_cov(module, data_id, callback_id)
 
 
+@app.websocket("/ws/scheme/{scheme_id}")
+async def scheme_websocket(websocket: WebSocket, scheme_id: str) -> None:
+    try:
+        scheme = schemes_controller.get_scheme(scheme_id)
+    except HTTPException as ex:
+        await websocket.accept()
+        await websocket.send_json({
+            "status": ex.status_code,
+            "detail": ex.detail,
+        })
+        await websocket.close()
+        return
+    # Points and SVG elements are identified by their index in binary
+    # messages
+    points = list(dict.fromkeys((element.data_module, element.data_id)
+                                for element in scheme.element))
+    handles = {point: handle for handle, point in enumerate(points)}
+    svg_ids = list(dict.fromkeys(element.svg_id
+                                 for element in scheme.element))
+    svg_handles = {svg_id: handle for handle, svg_id in enumerate(svg_ids)}
+    writable = {(element.data_module, element.data_id)
+                for element in scheme.element if element.write}
+    binary = BINARY_SUBPROTOCOL in websocket.scope.get("subprotocols", ()) \
+        and max(len(points), len(svg_ids)) <= MAX_HANDLES
+    covs: list[tuple[str, str]] = []
+    polls: list[tuple[str, str]] = []
+    subscriber_id = token_urlsafe(16)
+
+    def format_values(values: dict[tuple[str, str], Value]) \
+            -> Iterable[dict[str, Any] | bytes]:
+        if binary:
+            # Binary clients get the changes of the SVG, not values
+            deltas = [
+                (svg_handles[svg_id], style, text)
+                for (module, data_id), value in values.items()
+                if value is not None
+                for svg_id, (style, text) in schemes_controller.render_deltas(
+                    scheme_id, module, data_id, str(value),
+                ).items()
+            ]
+            return (encode_deltas(deltas),) if deltas else ()
+        modules: dict[str, dict[str, Value]] = {}
+        for (module, data_id), value in values.items():
+            modules.setdefault(module, {})[data_id] = value
+        return ({"data_module": module, "data": data}
+                for module, data in modules.items())
+
+    def send_values(module: str, values: dict[str, Value]) -> None:
+        sender.put_values({(module, data_id): value
+                           for data_id, value in values.items()
+                           if (module, data_id) in handles})
+
+    def module_callback(module: str) -> COVCallback:
+        async def callback(data_id: str, value: str | list[str]) -> None:
+            send_values(module, {data_id: value})
+        return callback
+
+    await websocket.accept(BINARY_SUBPROTOCOL if binary else None)
+    sender: WebSocketSender[tuple[str, str]] = _create_sender(websocket,
+                                                              format_values)
+    sender.start()
+    try:
+        if binary:
+            sender.put_message({"handles": points, "elements": svg_ids})
+        elements = {(element.data_module, element.data_id): element
+                    for element in reversed(scheme.element)}
+        for point in points:
+            element = elements[point]
+            callback = module_callback(element.data_module)
+            try:
+                # Elements of modules without COV messages are polled
+                if element.cov and await data_controller.register_cov(
+                    element.data_module, element.data_id, subscriber_id,
+                    callback,
+                ):
+                    covs.append(point)
+                    continue
+            except HTTPException as ex:
+                _logger.warning("Could not subscribe %r to COV messages, "
+                                "polling it: %s", point, ex.detail)
+            try:
+                await data_poller.subscribe(element.data_module,
+                                            element.data_id, subscriber_id,
+                                            scheme.interval, callback,
+                                            element.single)
+                polls.append(point)
+            except HTTPException as ex:
+                sender.put_message({
+                    "status": ex.status_code,
+                    "detail": ex.detail,
+                    "data_module": element.data_module,
+                })
+
+        while True:
+            data = await sender.receive_json()
+            try:
+                message = WSMessage(**data)
+                if message.command == "get":
+                    requested: dict[str, list[str]] = {}
+                    for handle in message.handles:
+                        if not 0 <= handle < len(points):
+                            raise HTTPException(404, "Invalid handle")
+                        module, data_id = points[handle]
+                        requested.setdefault(module, []).append(data_id)
+                    if message.data_ids:
+                        requested.setdefault(message.data_module, []) \
+                            .extend(message.data_ids)
+                    for module, data_ids in requested.items():
+                        if any((module, data_id) not in handles
+                               for data_id in data_ids):
+                            raise HTTPException(403, "Data id not in scheme")
+                    for module, data_ids in requested.items():
+                        send_values(module, await data_controller
+                                    .get_values(module, data_ids))
+                elif message.command == "set":
+                    if any((message.data_module, data_id) not in writable
+                           for data_id in message.data):
+                        raise HTTPException(403, "Data id not writable")
+                    send_values(
+                        message.data_module,
+                        await data_controller.set_values(message.data_module,
+                                                         message.data),
+                    )
+                else:
+                    sender.put_message({
+                        "status": 400,
+                        "detail": f"Invalid command '{message.command}'",
+                    })
+            except HTTPException as ex:
+                sender.put_message({
+                    "status": ex.status_code,
+                    "detail": ex.detail,
+                    "data_module": message.data_module,
+                })
+            except TypeError:
+                sender.put_message({
+                    "status": 400,
+                    "detail": "Invalid message",
+                })
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await sender.stop()
+        for module, data_id in polls:
+            await data_poller.unsubscribe(module, data_id, subscriber_id)
+        for module, data_id in covs:
+            await data_controller.remove_cov(module, data_id, subscriber_id)
+
+
 @app.get("/")
 async def get_index(request: Request) -> Response:
     return templates.TemplateResponse("index.html", {
@@ -164,16 +377,44 @@ async def get_index(request: Request) -> Response:
     })
 
 
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    return any(tag.strip().removeprefix("W/") in (etag, "*")
+               for tag in if_none_match.split(","))
+
+
 @app.get("/schemes/{scheme_id}")
 async def get_scheme(request: Request, scheme_id: str) -> Response:
     scheme_config = schemes_controller.get_scheme(scheme_id)
+    rendered = await schemes_controller.render_scheme(
+        scheme_id, data_controller, scheme_config.deadline,
+    )
+    headers = {"ETag": rendered.etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request, rendered.etag):
+        return Response(status_code=304, headers=headers)
     return templates.TemplateResponse("scheme.html", {
         "request": request,
-        "svg": await schemes_controller.build_svg(scheme_id, data_controller),
+        "svg": rendered.svg,
+        "pending": rendered.pending,
         "scheme_config": jsonable_encoder(scheme_config),
         "schemes": schemes_controller.get_schemes(),
         "scheme_name": scheme_config.scheme_name,
-    })
+    }, headers=headers)
+
+
+@app.get("/schemes/{scheme_id}/svg")
+async def get_scheme_svg(request: Request, scheme_id: str) -> Response:
+    scheme_config = schemes_controller.get_scheme(scheme_id)
+    rendered = await schemes_controller.render_scheme(
+        scheme_id, data_controller, scheme_config.deadline,
+    )
+    headers = {"ETag": rendered.etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request, rendered.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(rendered.svg, media_type="image/svg+xml",
+                    headers=headers)
 
 
 @app.get("/schemes/{scheme_id}/influx/{svg_id}")
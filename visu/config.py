@@ -3,6 +3,7 @@ from dataclasses import field
 from tomlconfig import configclass
 
 from .data.bacnet.config import BacnetDataModuleConfig
+from .data.config import AcquisitionConfig, CacheConfig
 from .data.modbus.config import ModbusDataModuleConfig
 from .data.snmp.config import SNMPDataModuleConfig
 from .scheme.config import (
@@ -18,6 +19,13 @@ class InfluxDdConfig:
     bucket: str = ""
 
 
+@configclass
+class WebSocketConfig:
+    send_timeout: float = 10
+    max_messages: int = 100
+    min_poll_interval: int = 1
+
+
 @configclass
 class Config:
     host: str = "0.0.0.0"
@@ -26,6 +34,10 @@ class Config:
     uvicorn_debug: bool = False
     influx_db: InfluxDdConfig = field(default_factory=InfluxDdConfig)
     schemes_dir: str = "/etc/visu/schemes"
+    cache: CacheConfig = field(default_factory=CacheConfig)
+    acquisition: AcquisitionConfig = \
+        field(default_factory=AcquisitionConfig)
+    websocket: WebSocketConfig = field(default_factory=WebSocketConfig)
 
     bacnet: BacnetDataModuleConfig = \
         field(default_factory=BacnetDataModuleConfig)
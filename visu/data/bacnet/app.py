@@ -6,12 +6,16 @@ from typing import Any
 
 from bacpypes.apdu import (
     ConfirmedCOVNotificationRequest,
+    IAmRequest,
     ReadPropertyACK,
     ReadPropertyMultipleACK,
+    ReadPropertyRequest,
     SimpleAckPDU,
 )
 from bacpypes.app import BIPSimpleApplication
+from bacpypes.basetypes import ServicesSupported
 from bacpypes.constructeddata import Array
+from bacpypes.core import deferred
 from bacpypes.iocb import IOCB
 from bacpypes.local.device import LocalDeviceObject
 from bacpypes.object import get_datatype
@@ -19,12 +23,22 @@ from bacpypes.pdu import Address
 from bacpypes.primitivedata import ObjectIdentifier, Unsigned
 from fastapi.exceptions import HTTPException
 
+from .bridge import LoopBridge
 from .config import BacnetDataModuleConfig
+from .devices import DeviceCache
 
 
 _logger = logging.getLogger(__name__)
 
 
+class BacnetIOError(HTTPException):
+    """Error, reject or abort received from a device"""
+
+    def __init__(self, error: Any) -> None:
+        super().__init__(500, f"Bacnet error {error}")
+        self.error = error
+
+
 class VizuApplication(BIPSimpleApplication):
     def __init__(self, config: BacnetDataModuleConfig,
                  cov_queue: Queue[tuple[Address, ObjectIdentifier, str,
@@ -39,6 +53,38 @@ class VizuApplication(BIPSimpleApplication):
         super().__init__(local_device, config.address)
         self.config = config
         self.cov_queue = cov_queue
+        self.bridge = LoopBridge()
+        self.devices = DeviceCache(config.device_cache)
+
+    def do_IAmRequest(self, apdu: IAmRequest) -> None:
+        super().do_IAmRequest(apdu)
+        _logger.debug("Received I-Am from %r", apdu.pduSource)
+        # Device cache is read and changed only in the event loop
+        self.bridge.call(self._process_iam, apdu)
+
+    def _process_iam(self, apdu: IAmRequest) -> None:
+        device = self.devices.update_from_iam(apdu)
+        if device.read_multiple is not None and device.cov is not None:
+            return
+        request = ReadPropertyRequest(
+            destination=apdu.pduSource,
+            objectIdentifier=apdu.iAmDeviceIdentifier,
+            propertyIdentifier="protocolServicesSupported",
+        )
+        iocb = IOCB(request)
+        iocb.add_callback(self.process_services_supported, apdu.pduSource)
+        deferred(self.request_io, iocb)
+
+    def process_services_supported(self, iocb: IOCB, address: Address) \
+            -> None:
+        if iocb.ioError or not isinstance(iocb.ioResponse, ReadPropertyACK):
+            _logger.debug("Could not read services supported by %r: %r",
+                          address, iocb.ioError)
+            return
+        services = iocb.ioResponse.propertyValue.cast_out(ServicesSupported)
+        self.bridge.call(self.devices.update_services, address,
+                         services.value)
+        _logger.debug("Device %r supports %r", address, services)
 
     def process_read_property_ack(self, apdu: ReadPropertyACK,
                                   future: Future[str | list[str]]) -> None:
@@ -47,7 +93,8 @@ class VizuApplication(BIPSimpleApplication):
         if not datatype:
             _logger.error("unknown datatype in a response from %r",
                           apdu.pduSource)
-            future.set_exception(HTTPException(500, "unknown datatype"))
+            self.bridge.set_exception(future,
+                                      HTTPException(500, "unknown datatype"))
             return
 
         if issubclass(datatype, Array) and apdu.propertyArrayIndex is not None:
@@ -58,33 +105,31 @@ class VizuApplication(BIPSimpleApplication):
         else:
             value = apdu.propertyValue.cast_out(datatype)
 
-        future.set_result(list(map(str, value)) if isinstance(value, list)
-                          else str(value))
+        self.bridge.set_result(future, list(map(str, value))
+                               if isinstance(value, list) else str(value))
 
-    def process_read_property_multiple_ack(self, apdu: ReadPropertyMultipleACK,
-                                           future: Future[dict[str, str
-                                                               | list[str]]]) \
-            -> None:
-        results: dict[str, str | list[str]] = {}
+    def process_read_property_multiple_ack(
+            self, apdu: ReadPropertyMultipleACK,
+            future: Future[dict[tuple[tuple[str, int], str], str | list[str]]],
+    ) -> None:
+        results: dict[tuple[tuple[str, int], str], str | list[str]] = {}
         for result in apdu.listOfReadAccessResults:
             for element in result.listOfResults:
+                key = (tuple(result.objectIdentifier),
+                       str(element.propertyIdentifier))
                 if element.readResult.propertyAccessError is not None:
                     _logger.error("%r", element.readResult.propertyAccessError)
-                    future.set_exception(HTTPException(
-                        500, "Could not access property: "
-                        f"{element.readResult.propertyAccessError}",
-                    ))
-                    return
+                    results[key] = "Could not access property: " \
+                        f"{element.readResult.propertyAccessError}"
+                    continue
 
                 datatype = get_datatype(result.objectIdentifier[0],
                                         element.propertyIdentifier)
                 if not datatype:
                     _logger.error("unknown datatype in a response from %r",
                                   apdu.pduSource)
-                    future.set_exception(HTTPException(
-                        500, "unknown datatype in a response",
-                    ))
-                    return
+                    results[key] = "unknown datatype in a response"
+                    continue
 
                 if issubclass(datatype, Array) \
                         and element.propertyArrayIndex is not None:
@@ -97,24 +142,21 @@ class VizuApplication(BIPSimpleApplication):
                 else:
                     value = element.readResult.propertyValue.cast_out(datatype)
 
-                results[str(apdu.pduSource)
-                        + "::" + str(result.objectIdentifier[0])
-                        + ":" + str(result.objectIdentifier[1])
-                        + "::" + str(element.propertyIdentifier)] = \
-                    list(map(str, value)) if isinstance(value, list) \
-                    else str(value)
-        future.set_result(results)
+                results[key] = list(map(str, value)) \
+                    if isinstance(value, list) else str(value)
+        self.bridge.set_result(future, results)
 
     def process_response_iocb(self, iocb: IOCB, future: Future[Any],
                               **kwargs: Any) -> None:
         if iocb.ioError:
             _logger.error("%r", iocb.ioError)
-            future.set_exception(HTTPException(500,
-                                               f"Bacnet error {iocb.ioError}"))
+            self.bridge.set_exception(future, BacnetIOError(iocb.ioError))
             return
         if not iocb.ioResponse:
             _logger.error("No error nor response in IOCB response")
-            future.set_exception(HTTPException(500, "No response nor error"))
+            self.bridge.set_exception(
+                future, HTTPException(500, "No response nor error"),
+            )
             return
 
         apdu = iocb.ioResponse
@@ -124,10 +166,10 @@ class VizuApplication(BIPSimpleApplication):
         elif isinstance(apdu, ReadPropertyMultipleACK):
             self.process_read_property_multiple_ack(apdu, future)
         elif isinstance(apdu, SimpleAckPDU):
-            future.set_result(True)
+            self.bridge.set_result(future, True)
         else:
             _logger.debug("Unhandled response type %r", type(apdu))
-            future.set_result(None)
+            self.bridge.set_result(future, None)
 
     def do_UnconfirmedCOVNotificationRequest(
             self, apdu: ConfirmedCOVNotificationRequest,
@@ -141,7 +183,7 @@ class VizuApplication(BIPSimpleApplication):
             value = element.value.tagList
             if len(value) == 1:
                 value = value[0].app_to_object().value
-            self.cov_queue.put_nowait((
+            self.bridge.call(self.cov_queue.put_nowait, (
                 apdu.pduSource,
                 ObjectIdentifier(apdu.monitoredObjectIdentifier),
                 element.propertyIdentifier,
@@ -0,0 +1,90 @@
+from asyncio import AbstractEventLoop, Future
+from collections import deque
+import logging
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable
+
+
+_logger = logging.getLogger(__name__)
+
+
+def _set_result(future: Future[Any], result: Any) -> None:
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: Future[Any], exception: BaseException) -> None:
+    if not future.done():
+        future.set_exception(exception)
+
+
+class LoopBridge:
+    """
+    Hands calls from the bacpypes thread over to the asyncio event loop.
+
+    Calls are queued and the loop is woken up only once for all calls queued
+    until it gets to run them, so bursts of responses cost a single wakeup.
+    """
+
+    def __init__(self) -> None:
+        self._loop: AbstractEventLoop | None = None
+        self._pending: deque[tuple[Callable[..., None], tuple[Any, ...],
+                                   float]] = deque()
+        self._lock = Lock()
+        self._scheduled = False
+
+        self._calls = 0
+        self._wakeups = 0
+        self._max_batch = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def attach(self, loop: AbstractEventLoop) -> None:
+        self._loop = loop
+
+    def get_stats(self) -> dict[str, int | float]:
+        return {
+            "pending": len(self._pending),
+            "calls": self._calls,
+            "wakeups": self._wakeups,
+            "max_batch": self._max_batch,
+            "avg_latency": self._latency_total / self._calls
+            if self._calls else 0.0,
+            "max_latency": self._latency_max,
+        }
+
+    def call(self, callback: Callable[..., None], *args: Any) -> None:
+        """Calls callback(*args) in the event loop, safe from any thread"""
+        assert self._loop is not None, "Bridge is not attached to a loop"
+        with self._lock:
+            self._pending.append((callback, args, monotonic()))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._loop.call_soon_threadsafe(self._run)
+
+    def set_result(self, future: Future[Any], result: Any) -> None:
+        self.call(_set_result, future, result)
+
+    def set_exception(self, future: Future[Any],
+                      exception: BaseException) -> None:
+        self.call(_set_exception, future, exception)
+
+    def _run(self) -> None:
+        with self._lock:
+            batch = self._pending
+            self._pending = deque()
+            self._scheduled = False
+        now = monotonic()
+        self._wakeups += 1
+        self._calls += len(batch)
+        self._max_batch = max(self._max_batch, len(batch))
+        for callback, args, queued in batch:
+            self._latency_total += now - queued
+            self._latency_max = max(self._latency_max, now - queued)
+            try:
+                callback(*args)
+            except Exception as ex:
+                _logger.warning("Exception in bridged call %r: %r", callback,
+                                ex)
@@ -4,6 +4,9 @@ from bacpypes.pdu import Address
 
 from tomlconfig import configclass
 
+from ..config import HealthConfig
+
+
 @configclass
 class BacnetDataModuleConfig:
     device_name: str = "visu"
@@ -14,4 +17,8 @@ class BacnetDataModuleConfig:
     segmentation_supported: str = "segmentedBoth"
     vendor_identifier: int = 555
     cov_lifetime: int = 5 * 60
+    cov_max_pending: int = 100
     timeout: int = 10
+    discovery_interval: int = 60 * 60
+    device_cache: str = ""
+    health: HealthConfig = field(default_factory=HealthConfig)
@@ -0,0 +1,141 @@
+import json
+import logging
+from os import makedirs, replace
+from os.path import dirname
+from threading import Lock
+from typing import Any
+
+from bacpypes.apdu import IAmRequest
+from bacpypes.basetypes import ServicesSupported
+from bacpypes.pdu import Address
+
+
+# Rough encoded size of a single property (with its object) in
+# a ReadPropertyMultiple ACK and of the rest of the ACK, used to estimate how
+# many properties fit into the APDU of a device
+_RPM_PROPERTY_SIZE = 24
+_RPM_OVERHEAD = 16
+# Number of segments a segmented response is allowed to use
+_RPM_MAX_SEGMENTS = 4
+
+_logger = logging.getLogger(__name__)
+
+
+class DeviceCapabilities:
+    """Known limits and supported services of a remote BACnet device"""
+
+    def __init__(self, max_apdu: int = 480,
+                 segmentation: str = "noSegmentation") -> None:
+        self.device_identifier: int | None = None
+        self.vendor_identifier: int | None = None
+        self.max_apdu = max_apdu
+        self.segmentation = segmentation
+        # None if it is not known yet
+        self.read_multiple: bool | None = None
+        self.write_multiple: bool | None = None
+        self.cov: bool | None = None
+        # Lowered when the device aborts a response that is too long
+        self.max_properties: int | None = None
+
+    @property
+    def segmented_response(self) -> bool:
+        return self.segmentation in ("segmentedBoth", "segmentedTransmit")
+
+    def rpm_chunk_size(self) -> int:
+        apdu = self.max_apdu \
+            * (_RPM_MAX_SEGMENTS if self.segmented_response else 1)
+        size = max((apdu - _RPM_OVERHEAD) // _RPM_PROPERTY_SIZE, 1)
+        if self.max_properties is not None:
+            size = min(size, self.max_properties)
+        return size
+
+    def to_dict(self) -> dict[str, Any]:
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "DeviceCapabilities":
+        device = cls()
+        for attr, value in data.items():
+            if hasattr(device, attr):
+                setattr(device, attr, value)
+        return device
+
+
+class DeviceCache:
+    """
+    Capabilities of remote devices learned from I-Am messages, their
+    protocolServicesSupported property and responses to requests, which are
+    persisted to path (if set) so they are known right after a restart
+    """
+
+    def __init__(self, path: str = "") -> None:
+        self.path = path
+        self._devices: dict[Address, DeviceCapabilities] = {}
+        self._lock = Lock()
+        # Saves run in executor threads
+        self._save_lock = Lock()
+        self._saved = ""
+
+    def get(self, address: Address) -> DeviceCapabilities:
+        with self._lock:
+            if address not in self._devices:
+                self._devices[address] = DeviceCapabilities()
+            return self._devices[address]
+
+    def update_from_iam(self, apdu: IAmRequest) -> DeviceCapabilities:
+        device = self.get(apdu.pduSource)
+        device.device_identifier = apdu.iAmDeviceIdentifier[1]
+        device.vendor_identifier = apdu.vendorID
+        device.max_apdu = apdu.maxAPDULengthAccepted
+        device.segmentation = str(apdu.segmentationSupported)
+        return device
+
+    def update_services(self, address: Address, services: list[int]) -> None:
+        device = self.get(address)
+        bit_names = ServicesSupported.bitNames
+        device.read_multiple = \
+            bool(services[bit_names["readPropertyMultiple"]])
+        device.write_multiple = \
+            bool(services[bit_names["writePropertyMultiple"]])
+        device.cov = bool(services[bit_names["subscribeCOV"]])
+
+    def load(self) -> None:
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r", encoding="utf_8") as cache_file:
+                data = json.load(cache_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as ex:
+            _logger.warning("Could not load BACnet device cache %r: %r",
+                            self.path, ex)
+            return
+        with self._lock:
+            for address, device in data.items():
+                self._devices[Address(address)] = \
+                    DeviceCapabilities.from_dict(device)
+        _logger.debug("Loaded %r BACnet devices from cache", len(data))
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                data = json.dumps({str(address): device.to_dict()
+                                   for address, device
+                                   in self._devices.items()},
+                                  indent=4)
+            if data == self._saved:
+                return
+            try:
+                if dirname(self.path):
+                    makedirs(dirname(self.path), exist_ok=True)
+                with open(f"{self.path}.tmp", "w",
+                          encoding="utf_8") as cache_file:
+                    cache_file.write(data)
+                replace(f"{self.path}.tmp", self.path)
+                self._saved = data
+            except OSError as ex:
+                _logger.warning("Could not save BACnet device cache %r: %r",
+                                self.path, ex)
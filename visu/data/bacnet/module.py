@@ -1,16 +1,26 @@
-from asyncio import TimeoutError as ATimeoutError, wait_for
+from asyncio import (
+    TimeoutError as ATimeoutError,
+    get_running_loop,
+    sleep,
+    wait_for,
+)
 from asyncio.futures import Future
 from asyncio.locks import Lock
 from asyncio.queues import Queue
 from asyncio.tasks import Task, create_task, gather
 import logging
 from threading import Thread
-from typing import Iterable
+from typing import Any as PyAny, Iterable
 
 from bacpypes.apdu import (
+    AbortPDU,
+    AbortReason,
+    ConfirmedRequestSequence,
     ReadAccessSpecification,
     ReadPropertyMultipleRequest,
     ReadPropertyRequest,
+    RejectPDU,
+    RejectReason,
     WritePropertyRequest,
 )
 from bacpypes.basetypes import PropertyReference
@@ -37,14 +47,36 @@ from bacpypes.primitivedata import (
 from fastapi.exceptions import HTTPException
 
 from ..base import COVCallback, DataModule
-from .app import VizuApplication
+from ..dataid import DataIdLookup
+from ..dispatcher import COVDispatcher
+from ..health import DeviceUnavailable, HealthTracker, unavailable
+from .app import BacnetIOError, VizuApplication
 from .config import BacnetDataModuleConfig
-from .tasks import SubscribeCOVTask
+from .devices import DeviceCapabilities
+from .tasks import DiscoveryTask, SubscribeCOVTask
+
 
+_UNRECOGNIZED_SERVICE = RejectReason("unrecognizedService").get_long()
+_TOO_LONG_REASONS = (
+    AbortReason("bufferOverflow").get_long(),
+    AbortReason("segmentationNotSupported").get_long(),
+    AbortReason("apduTooLong").get_long(),
+)
 
 _logger = logging.getLogger(__name__)
 
 
+class BacnetDataId:
+    __slots__ = ("address", "object_identifier", "property_identifier")
+
+    def __init__(self, address: Address, object_identifier: ObjectIdentifier,
+                 property_identifier: str | None) -> None:
+        self.address = address
+        self.object_identifier = object_identifier
+        # None for data ids of whole objects, e.g. for COV subscriptions
+        self.property_identifier = property_identifier
+
+
 class BacnetDataModule(DataModule):
     name = "bacnet"
 
@@ -53,121 +85,229 @@ class BacnetDataModule(DataModule):
         self.cov_queue: Queue[tuple[Address, ObjectIdentifier, str,
                                     str | list[str]]] = Queue()
         self.cov_requests: dict[tuple[Address, ObjectIdentifier],
-                                tuple[SubscribeCOVTask,
-                                      dict[str, COVCallback]]] = {}
+                                SubscribeCOVTask] = {}
         self.cov_lock = Lock()
+        self.cov_dispatcher = COVDispatcher(config.cov_max_pending)
         self.cov_queue_task: Task[None] | None = None
         self.app = VizuApplication(config, self.cov_queue)
         self.thread: Thread = Thread(target=run)
+        self.discovery_task = DiscoveryTask(self.app,
+                                            config.discovery_interval)
+        self.device_cache_task: Task[None] | None = None
+        self._discovery_requested: set[Address] = set()
+        self._health = HealthTracker(config.health)
+        self._data_ids = DataIdLookup(self._parse_handle)
 
     async def start(self) -> None:
+        # Cache file is read and written in the default executor, so it does
+        # not block the event loop
+        await get_running_loop().run_in_executor(None, self.app.devices.load)
+        self.app.bridge.attach(get_running_loop())
         self.thread.start()
         self.cov_queue_task = create_task(self._cov_queue_mgr())
+        if self.config.discovery_interval > 0:
+            self.discovery_task.install_task()
+        self.device_cache_task = create_task(self._save_device_cache())
 
     async def stop(self) -> None:
+        self.discovery_task.cancel_task()
         stop()
         if self.cov_queue_task is not None:
             self.cov_queue_task.cancel()
+        await self.cov_dispatcher.stop()
+        if self.device_cache_task is not None:
+            self.device_cache_task.cancel()
+        await get_running_loop().run_in_executor(None, self.app.devices.save)
 
-    def _parse_data_id(self, data_id: str, require_prop: bool = True) \
-            -> tuple[Address, ObjectIdentifier, str]:
+    def get_stats(self) -> dict[str, object]:
+        return {
+            "bridge": self.app.bridge.get_stats(),
+            "cov_queue": self.cov_queue.qsize(),
+            "cov": self.cov_dispatcher.get_stats(),
+            "health": self._health.get_stats(),
+        }
+
+    async def _save_device_cache(self) -> None:
+        while True:
+            await sleep(60)
+            await get_running_loop().run_in_executor(None,
+                                                     self.app.devices.save)
+
+    def _get_device(self, address: Address) -> DeviceCapabilities:
+        device = self.app.devices.get(address)
+        if device.device_identifier is None \
+                and address not in self._discovery_requested:
+            # Ask the device directly about itself instead of waiting for the
+            # next discovery broadcast
+            self._discovery_requested.add(address)
+            deferred(self.app.who_is, None, None, address)
+        return device
+
+    def compile_data_ids(self, data_ids: Iterable[str]) -> None:
+        self._data_ids.compile(data_ids)
+
+    @staticmethod
+    def _parse_handle(data_id: str) -> BacnetDataId:
         try:
             data = data_id.split("::")
-            return Address(data[0]), ObjectIdentifier(data[1]), \
-                (data[2] if require_prop else "")
-        except (ValueError, KeyError, TypeError) as ex:
+            return BacnetDataId(Address(data[0]), ObjectIdentifier(data[1]),
+                                data[2] if len(data) > 2 else None)
+        except (ValueError, KeyError, TypeError, IndexError) as ex:
             raise HTTPException(400, "Invalid data_id") from ex
 
+    def _parse_data_id(self, data_id: str, require_prop: bool = True) \
+            -> tuple[Address, ObjectIdentifier, str]:
+        handle = self._data_ids.get(data_id)
+        if not require_prop:
+            return handle.address, handle.object_identifier, ""
+        if handle.property_identifier is None:
+            raise HTTPException(400, "Invalid data_id")
+        return handle.address, handle.object_identifier, \
+            handle.property_identifier
+
     async def _cov_queue_mgr(self) -> None:
         while True:
             address, object_identifier, property_identifier, value = \
                 await self.cov_queue.get()
-            await self.cov_lock.acquire()
-            try:
-                data_id = (address, object_identifier)
-                if data_id not in self.cov_requests:
-                    return
-                cov_callbacks = self.cov_requests[data_id][1].values()
-                await DataModule.call_covs(
-                    str(address) + "::" + str(object_identifier.value[0]) + ":"
-                    + str(object_identifier.value[1]) + "::"
-                    + str(property_identifier),
-                    value, cov_callbacks, _logger,
-                )
-            except Exception as ex:
-                _logger.warning("An exception occurred while calling CoV %r",
-                                ex)
-            finally:
-                self.cov_lock.release()
+            did = (address, object_identifier)
+            if not self.cov_dispatcher.has(did):
+                _logger.debug("CoV notification for unknown object %r",
+                              did)
+                continue
+            self.cov_dispatcher.dispatch(
+                did,
+                str(address) + "::" + str(object_identifier.value[0]) + ":"
+                + str(object_identifier.value[1]) + "::"
+                + str(property_identifier),
+                value,
+            )
+
+    async def _request(self, request: ConfirmedRequestSequence) -> PyAny:
+        health = self._health.get(str(request.pduDestination),
+                                  self.config.timeout)
+        probe = health.acquire()
+        iocb = IOCB(request)
+        future: Future[PyAny] = Future()
+        iocb.add_callback(self.app.process_response_iocb, future)
+        deferred(self.app.request_io, iocb)
+        return await health.run(future, probe=probe)
 
     async def get_value(self, data_id: str) -> str | list[str]:
-        try:
-            address, object_identifier, property_identifier = \
-                self._parse_data_id(data_id)
+        address, object_identifier, property_identifier = \
+            self._parse_data_id(data_id)
+        return await self._request(ReadPropertyRequest(
+            destination=address,
+            objectIdentifier=object_identifier,
+            propertyIdentifier=property_identifier,
+        ))
 
-            request = ReadPropertyRequest(
-                destination=address,
-                objectIdentifier=object_identifier,
-                propertyIdentifier=property_identifier,
+    async def _read_each(self, properties: list[tuple[str, ObjectIdentifier,
+                                                      str]]) \
+            -> dict[str, str | list[str]]:
+        async def read(data_id: str) -> str | list[str]:
+            try:
+                return await self.get_value(data_id)
+            except BacnetIOError as ex:
+                return str(ex.detail)
+        return dict(zip(
+            (data_id for data_id, _, _ in properties),
+            await gather(*(read(data_id) for data_id, _, _ in properties)),
+        ))
+
+    def _build_read_multiple_request(
+            self, address: Address,
+            properties: list[tuple[str, ObjectIdentifier, str]],
+    ) -> ReadPropertyMultipleRequest:
+        specs: dict[ObjectIdentifier, list[PropertyReference]] = {}
+        for _, object_identifier, property_identifier in properties:
+            if object_identifier not in specs:
+                specs[object_identifier] = []
+            specs[object_identifier].append(
+                PropertyReference(propertyIdentifier=property_identifier),
             )
-            iocb = IOCB(request)
-            future: Future[str | list[str]] = Future()
-            iocb.add_callback(self.app.process_response_iocb, future)
-            deferred(self.app.request_io, iocb)
+        return ReadPropertyMultipleRequest(
+            destination=address,
+            listOfReadAccessSpecs=[
+                ReadAccessSpecification(
+                    objectIdentifier=object_identifier,
+                    listOfPropertyReferences=property_references,
+                )
+                for object_identifier, property_references in specs.items()
+            ],
+        )
 
-            result = await wait_for(future, self.config.timeout)
-            return result
-        except ATimeoutError as ex:
-            raise HTTPException(500, "Bacnet device timeout") from ex
+    async def _read_multiple(self, address: Address,
+                             properties: list[tuple[str, ObjectIdentifier,
+                                                    str]]) \
+            -> dict[str, str | list[str]]:
+        device = self._get_device(address)
+        if device.read_multiple is False:
+            return await self._read_each(properties)
+        try:
+            values = await self._request(
+                self._build_read_multiple_request(address, properties),
+            )
+        except BacnetIOError as ex:
+            reason = getattr(ex.error, "apduAbortRejectReason", None)
+            if isinstance(ex.error, RejectPDU) \
+                    and reason == _UNRECOGNIZED_SERVICE:
+                _logger.info("Device %r does not support "
+                             "ReadPropertyMultiple", address)
+                device.read_multiple = False
+            elif isinstance(ex.error, AbortPDU) \
+                    and reason in _TOO_LONG_REASONS \
+                    and len(properties) > 1:
+                half = len(properties) // 2
+                _logger.info("Response from %r too long, reading at most %r "
+                             "properties at once", address, half)
+                device.max_properties = half
+                first, second = await gather(
+                    self._read_multiple(address, properties[:half]),
+                    self._read_multiple(address, properties[half:]),
+                )
+                first.update(second)
+                return first
+            # Read properties separately to find out which one has failed
+            return await self._read_each(properties)
+        device.read_multiple = True
+        return {
+            data_id: values.get((object_identifier.value,
+                                 str(property_identifier)),
+                                "Property missing in the response")
+            for data_id, object_identifier, property_identifier in properties
+        }
 
-    def _build_read_multiple_requests(self, data_ids: Iterable[str]) \
-            -> Iterable[ReadPropertyMultipleRequest]:
-        requests: dict[Address,
-                       dict[ObjectIdentifier,
-                            list[PropertyReference]]] = {}
-        for data_id in data_ids:
+    async def get_value_multiple(self, data_ids: Iterable[str]) \
+            -> dict[str, str | list[str]]:
+        requests: dict[Address, list[tuple[str, ObjectIdentifier, str]]] = {}
+        for data_id in dict.fromkeys(data_ids):
             address, object_identifier, property_identifier = \
                 self._parse_data_id(data_id)
             if address not in requests:
-                requests[address] = {}
-            if object_identifier not in requests[address]:
-                requests[address][object_identifier] = []
-            requests[address][object_identifier].append(
-                PropertyReference(propertyIdentifier=property_identifier),
-            )
+                requests[address] = []
+            requests[address].append((data_id, object_identifier,
+                                      property_identifier))
 
-        return map(
-            lambda address: ReadPropertyMultipleRequest(
-                destination=address,
-                listOfReadAccessSpecs=list(map(
-                    lambda object_identifier: ReadAccessSpecification(
-                        objectIdentifier=object_identifier,
-                        listOfPropertyReferences=requests[address][object_identifier]
-                    ),
-                    requests[address],
-                )),
-            ),
-            requests,
-        )
+        chunks: list[tuple[Address, list[tuple[str, ObjectIdentifier,
+                                               str]]]] = []
+        for address, properties in requests.items():
+            size = self._get_device(address).rpm_chunk_size()
+            chunks.extend((address, properties[i:i + size])
+                          for i in range(0, len(properties), size))
 
-    async def get_value_multiple(self, data_ids: Iterable[str]) \
-            -> dict[str, str | list[str]]:
-        try:
-            futures: list[Future[dict[str, str | list[str]]]] = []
-            for request in self._build_read_multiple_requests(data_ids):
-                future: Future[dict[str, str | list[str]]] = Future()
-                futures.append(future)
-                iocb = IOCB(request)
-                iocb.add_callback(self.app.process_response_iocb, future)
-                deferred(self.app.request_io, iocb)
-            results = await wait_for(gather(*futures), self.config.timeout)
-
-            result: dict[str, str | list[str]] = {}
-            for res in results:
-                result.update(res)
-            return result
-        except ATimeoutError as ex:
-            raise HTTPException(500, "Bacnet device timeout") from ex
+        async def read(address: Address,
+                       properties: list[tuple[str, ObjectIdentifier, str]]) \
+                -> dict[str, str | list[str]]:
+            try:
+                return await self._read_multiple(address, properties)
+            except DeviceUnavailable:
+                return unavailable(data_id for data_id, _, _ in properties)
+
+        result: dict[str, str | list[str]] = {}
+        for values in await gather(*(read(address, properties)
+                                     for address, properties in chunks)):
+            result.update(values)
+        return result
 
     async def set_value(self, data_id: str, value: str) -> str | None:
         address, object_identifier, property_identifier = \
@@ -215,16 +355,8 @@ class BacnetDataModule(DataModule):
             propertyIdentifier=property_identifier,
             propertyValue=req_value,
         )
-        iocb = IOCB(request)
-        future: Future[str | list[str]] = Future()
-        iocb.add_callback(self.app.process_response_iocb, future)
-        deferred(self.app.request_io, iocb)
-
-        try:
-            result = await wait_for(future, self.config.timeout)
-            return value if result else None
-        except ATimeoutError as ex:
-            raise HTTPException(500, "Bacnet device timeout") from ex
+        result = await self._request(request)
+        return value if result else None
 
     async def register_cov(self, data_id: str, callback_id: str,
                            callback: COVCallback) -> bool:
@@ -233,17 +365,22 @@ class BacnetDataModule(DataModule):
         try:
             did = (address, object_identifier)
             if did in self.cov_requests \
-                    and not self.cov_requests[did][0].cancelled:
-                self.cov_requests[did][1][callback_id] = callback
+                    and not self.cov_requests[did].cancelled:
+                self.cov_dispatcher.add(did, callback_id, callback)
                 return True
+            if self._get_device(address).cov is False:
+                _logger.debug("Device %r does not support COV", address)
+                return False
             future: Future[bool] = Future()
             task = SubscribeCOVTask(self.app, address, object_identifier,
-                                    self.config.cov_lifetime, future)
+                                    self.config.cov_lifetime, future,
+                                    self.app.bridge)
             task.install_task()
             result = await wait_for(future, self.config.timeout)
             if not result:
                 return False
-            self.cov_requests[did] = (task, {callback_id: callback})
+            self.cov_requests[did] = task
+            self.cov_dispatcher.add(did, callback_id, callback)
             return True
         except ATimeoutError as ex:
             raise HTTPException(500, "Bacnet device timeout") from ex
@@ -255,12 +392,11 @@ class BacnetDataModule(DataModule):
         await self.cov_lock.acquire()
         try:
             did = (address, object_identifier)
-            if did not in self.cov_requests \
-                    or callback_id not in self.cov_requests[did][1]:
+            if not self.cov_dispatcher.has(did, callback_id):
                 return
-            del self.cov_requests[did][1][callback_id]
-            if len(self.cov_requests[did][1]) == 0:
-                self.cov_requests[did][0].cancel_task()
+            self.cov_dispatcher.remove(did, callback_id)
+            if not self.cov_dispatcher.has(did):
+                self.cov_requests[did].cancel_task()
                 del self.cov_requests[did]
         finally:
             self.cov_lock.release()
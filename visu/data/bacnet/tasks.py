@@ -10,11 +10,14 @@ from bacpypes.apdu import (
 )
 from bacpypes.core import deferred
 from bacpypes.iocb import IOCB, IOController
+from bacpypes.service.device import WhoIsIAmServices
 from bacpypes.pdu import Address
 from bacpypes.primitivedata import ObjectIdentifier
 from bacpypes.task import OneShotTask
 from fastapi.exceptions import HTTPException
 
+from .bridge import LoopBridge
+
 
 _logger = logging.getLogger(__name__)
 
@@ -45,6 +48,17 @@ class _BaseRecurringTask(OneShotTask):
         self.cancelled = True
 
 
+class DiscoveryTask(_BaseRecurringTask):
+    def __init__(self, app: WhoIsIAmServices, interval: int) -> None:
+        self.app = app
+        super().__init__(interval, 0)
+
+    def process_task(self) -> None:
+        super().process_task()
+        _logger.debug("Discovering BACnet devices")
+        self.app.who_is()
+
+
 class _BaseIOTask(_BaseRecurringTask):
     def __init__(self, io_controller: IOController, interval: int,
                  offset: float | None = None,
@@ -73,12 +87,13 @@ class _BaseIOTask(_BaseRecurringTask):
 class SubscribeCOVTask(_BaseIOTask):
     def __init__(self, io_controller: IOController, address: Address,
                  object_identifier: ObjectIdentifier, cov_lifetime: int,
-                 future: Future[bool]) \
+                 future: Future[bool], bridge: LoopBridge) \
             -> None:
         self.address = address
         self.object_identifier = object_identifier
         self.lifetime = cov_lifetime
         self.future = future
+        self.bridge = bridge
         super().__init__(io_controller, cov_lifetime, 0)
 
     def _build_requests(self) -> Iterable[ConfirmedRequestSequence]:
@@ -94,16 +109,14 @@ class SubscribeCOVTask(_BaseIOTask):
         if iocb.ioError:
             _logger.error("Failed to subscribe to %r@%r: %r",
                           self.object_identifier, self.address, iocb.ioError)
-            if not self.future.done():
-                self.future.set_exception(HTTPException(
-                    500, f"Failed to subscribe to COV: {iocb.ioError}",
-                ))
+            self.bridge.set_exception(self.future, HTTPException(
+                500, f"Failed to subscribe to COV: {iocb.ioError}",
+            ))
             self.cancel_task()
         else:
             _logger.debug("Subsribed to %r@%r", self.object_identifier,
                           self.address)
-            if not self.future.done():
-                self.future.set_result(True)
+            self.bridge.set_result(self.future, True)
 
     def _add_callback(self, iocb: IOCB) -> None:
         iocb.add_callback(self.process_subscribe_ack)
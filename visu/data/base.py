@@ -13,6 +13,12 @@ class DataModule:
     async def stop(self) -> None:
         pass
 
+    def get_stats(self) -> dict[str, object]:
+        return {}
+
+    def compile_data_ids(self, data_ids: Iterable[str]) -> None:
+        """Parses data ids known in advance, e.g. from schemes"""
+
     async def get_value(self, data_id: str) -> str | list[str]:
         raise NotImplementedError(self.get_value.__qualname__)
 
@@ -0,0 +1,195 @@
+"""Cache of data values shared by all consumers of the data controller"""
+import asyncio
+import logging
+from time import monotonic
+from typing import Awaitable, Callable, Iterable
+
+from .config import CacheConfig
+from .health import UNAVAILABLE
+
+
+_logger = logging.getLogger(__name__)
+
+Fetch = Callable[[list[str]], Awaitable[dict[str, str | list[str]]]]
+
+
+def _retrieve_exception(task: asyncio.Task[dict[str, str | list[str]]]) \
+        -> None:
+    # Fetches are shielded, the exception of a fetch whose requesters have
+    # all been cancelled would be logged as never retrieved
+    if not task.cancelled():
+        task.exception()
+
+
+class ValueCache:
+    """
+    Keeps recently read values for their max age and makes concurrent
+    requests for the same data ids share a single fetch from the module
+    """
+
+    def __init__(self, config: CacheConfig) -> None:
+        self.config = config
+        self._max_ages: dict[tuple[str, str], float] = {}
+        # (expires, value), ordered by the time of storing
+        self._values: dict[tuple[str, str],
+                           tuple[float, str | list[str]]] = {}
+        self._inflight: dict[tuple[str, str],
+                             asyncio.Task[dict[str, str | list[str]]]] = {}
+
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._retries = 0
+        self._invalidations = 0
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._values),
+            "inflight": len(self._inflight),
+            "hits": self._hits,
+            "misses": self._misses,
+            "coalesced": self._coalesced,
+            "retries": self._retries,
+            "invalidations": self._invalidations,
+        }
+
+    def set_max_age(self, module: str, data_id: str, max_age: float) -> None:
+        self._max_ages[(module, data_id)] = max_age
+
+    def _max_age(self, key: tuple[str, str]) -> float:
+        if key in self._max_ages:
+            return self._max_ages[key]
+        return self.config.module_max_age.get(key[0], self.config.max_age)
+
+    def _store(self, key: tuple[str, str], value: str | list[str],
+               now: float) -> None:
+        max_age = self._max_age(key)
+        if max_age <= 0:
+            return
+        self._values.pop(key, None)
+        self._values[key] = (now + max_age, value)
+        while len(self._values) > self.config.max_entries:
+            del self._values[next(iter(self._values))]
+
+    def update(self, module: str, data_id: str,
+               value: str | list[str]) -> None:
+        """Stores a value pushed by the module, e.g. from a COV message"""
+        key = (module, data_id)
+        self._inflight.pop(key, None)
+        if value == UNAVAILABLE:
+            self._values.pop(key, None)
+            return
+        self._store(key, value, monotonic())
+
+    def peek(self, module: str, data_ids: Iterable[str]) \
+            -> dict[str, str | list[str]]:
+        """Returns last known values of data_ids even if they are too old"""
+        values: dict[str, str | list[str]] = {}
+        for data_id in data_ids:
+            cached = self._values.get((module, data_id))
+            if cached is not None:
+                values[data_id] = cached[1]
+        return values
+
+    def invalidate(self, module: str, data_ids: Iterable[str]) -> None:
+        """
+        Drops cached values of data_ids, values of fetches already in flight
+        are not stored
+        """
+        for data_id in data_ids:
+            key = (module, data_id)
+            self._values.pop(key, None)
+            self._inflight.pop(key, None)
+            self._invalidations += 1
+
+    async def _fetch(self, module: str, data_ids: list[str],
+                     fetch: Fetch) -> dict[str, str | list[str]]:
+        task = asyncio.current_task()
+        try:
+            values = await fetch(data_ids)
+            now = monotonic()
+            for data_id, value in values.items():
+                key = (module, data_id)
+                # Values of unavailable devices are read again by next reads
+                if self._inflight.get(key) is task and value != UNAVAILABLE:
+                    self._store(key, value, now)
+            return values
+        finally:
+            for data_id in data_ids:
+                key = (module, data_id)
+                if self._inflight.get(key) is task:
+                    del self._inflight[key]
+
+    def _start_fetch(self, module: str, data_ids: list[str], fetch: Fetch) \
+            -> asyncio.Task[dict[str, str | list[str]]]:
+        task = asyncio.create_task(self._fetch(module, data_ids, fetch))
+        task.add_done_callback(_retrieve_exception)
+        for data_id in data_ids:
+            self._inflight[(module, data_id)] = task
+        return task
+
+    @staticmethod
+    def _take(module: str, data_id: str, values: dict[str, str | list[str]],
+              result: dict[str, str | list[str]]) -> None:
+        value = values.get(data_id)
+        if value is None:
+            _logger.warning("Module %r returned no value of %r", module,
+                            data_id)
+            return
+        result[data_id] = value
+
+    async def get(self, module: str, data_ids: Iterable[str],
+                  fetch: Fetch) -> dict[str, str | list[str]]:
+        """
+        Returns values of data_ids, fetching those that are neither cached
+        nor already being fetched with a single call of fetch.
+
+        Data ids whose fetch started by another caller fails are fetched
+        again, so only failures of fetch of own data ids are raised. Data ids
+        missing in the values returned by fetch are left out.
+        """
+        now = monotonic()
+        result: dict[str, str | list[str]] = {}
+        waiting: dict[str, asyncio.Task[dict[str, str | list[str]]]] = {}
+        missing: list[str] = []
+        for data_id in dict.fromkeys(data_ids):
+            key = (module, data_id)
+            cached = self._values.get(key)
+            if cached is not None and cached[0] > now:
+                self._hits += 1
+                result[data_id] = cached[1]
+            elif key in self._inflight:
+                self._coalesced += 1
+                waiting[data_id] = self._inflight[key]
+            else:
+                self._misses += 1
+                missing.append(data_id)
+
+        own = None
+        if missing:
+            own = self._start_fetch(module, missing, fetch)
+            for data_id in missing:
+                waiting[data_id] = own
+
+        tasks = set(waiting.values())
+        await asyncio.gather(*map(asyncio.shield, tasks),
+                             return_exceptions=True)
+        retry: list[str] = []
+        for data_id, task in waiting.items():
+            if task is not own and (task.cancelled()
+                                    or task.exception() is not None
+                                    or data_id not in task.result()):
+                # The fetch of another caller failed, e.g. on its own invalid
+                # data id, data_id is fetched again for this caller
+                retry.append(data_id)
+            else:
+                self._take(module, data_id, task.result(), result)
+
+        if retry:
+            self._retries += len(retry)
+            values = await asyncio.shield(
+                self._start_fetch(module, retry, fetch),
+            )
+            for data_id in retry:
+                self._take(module, data_id, values, result)
+        return result
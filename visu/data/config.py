@@ -0,0 +1,30 @@
+from dataclasses import field
+
+from tomlconfig import configclass
+
+
+@configclass
+class CacheConfig:
+    max_age: float = 1.0
+    module_max_age: dict[str, float] = field(default_factory=dict)
+    max_entries: int = 10000
+
+
+@configclass
+class AcquisitionConfig:
+    grace_period: float = 30
+
+
+@configclass
+class PolledCOVConfig:
+    interval: float = 5
+    deadband: float = 0
+    relative_deadband: float = 0
+
+
+@configclass
+class HealthConfig:
+    min_timeout: float = 1
+    failure_threshold: int = 3
+    open_time: float = 10
+    max_open_time: float = 300
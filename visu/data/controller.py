@@ -1,15 +1,33 @@
-from typing import Iterable
+import asyncio
+import logging
+from secrets import token_urlsafe
+from typing import Iterable, cast
 
 from fastapi.exceptions import HTTPException
 
 from ..config import Config
 from .bacnet.module import BacnetDataModule
 from .base import COVCallback, DataModule
+from .cache import ValueCache
+from .health import DeviceUnavailable, unavailable
 from .modbus.module import ModbusDataModule
 from .random import RandomDataModule
 from .snmp.module import SNMPDataModule
 
 
+_logger = logging.getLogger(__name__)
+
+
+class _COVAcquisition:
+    """COV subscription of a module shared by local subscribers of a point"""
+
+    def __init__(self) -> None:
+        self.callback_id = token_urlsafe(16)
+        self.callbacks: dict[str, COVCallback] = {}
+        self.registered: asyncio.Task[bool] | None = None
+        self.release: asyncio.TimerHandle | None = None
+
+
 class DataController:
     def __init__(self, config: Config) -> None:
         self.data_modules: dict[str, DataModule] = {
@@ -18,25 +36,67 @@ class DataController:
             ModbusDataModule.name: ModbusDataModule(config.modbus),
             SNMPDataModule.name: SNMPDataModule(config.snmp)
         }
+        self.cache = ValueCache(config.cache)
+        self.acquisition = config.acquisition
+        self._covs: dict[tuple[str, str], _COVAcquisition] = {}
+        self._release_tasks: set[asyncio.Task[None]] = set()
+        self._acquired = 0
+        self._released = 0
 
     async def start(self) -> None:
         for _, data_module in self.data_modules.items():
             await data_module.start()
 
     async def stop(self) -> None:
+        for acquisition in self._covs.values():
+            if acquisition.release is not None:
+                acquisition.release.cancel()
+        for task in self._release_tasks:
+            task.cancel()
         for _, data_module in self.data_modules.items():
             await data_module.stop()
 
+    def get_stats(self) -> dict[str, dict[str, object]]:
+        stats: dict[str, dict[str, object]] = {
+            name: data_module.get_stats()
+            for name, data_module in self.data_modules.items()
+        }
+        stats["cache"] = dict(self.cache.get_stats())
+        stats["cov_demand"] = {
+            "points": len(self._covs),
+            "subscribers": sum(len(acquisition.callbacks)
+                               for acquisition in self._covs.values()),
+            "lingering": sum(acquisition.release is not None
+                             for acquisition in self._covs.values()),
+            "acquired": self._acquired,
+            "released": self._released,
+        }
+        return stats
+
+    def compile_data_ids(self, data_module: str,
+                         data_ids: Iterable[str]) -> None:
+        if data_module in self.data_modules:
+            self.data_modules[data_module].compile_data_ids(data_ids)
+
     async def get_values(self, data_module: str, data_ids: Iterable[str]) \
             -> dict[str, str | list[str]]:
         if data_module not in self.data_modules:
             raise HTTPException(404, "Data module not found")
-        data_ids = list(data_ids)
+        return await self.cache.get(
+            data_module, data_ids,
+            lambda data_ids: self._fetch_values(data_module, data_ids),
+        )
+
+    async def _fetch_values(self, data_module: str, data_ids: list[str]) \
+            -> dict[str, str | list[str]]:
         if len(data_ids) == 1:
-            return {
-                data_ids[0]: await self.data_modules[data_module]
-                .get_value(data_ids[0]),
-            }
+            try:
+                return {
+                    data_ids[0]: await self.data_modules[data_module]
+                    .get_value(data_ids[0]),
+                }
+            except DeviceUnavailable:
+                return unavailable(data_ids)
         return await self.data_modules[data_module] \
             .get_value_multiple(data_ids)
 
@@ -44,25 +104,123 @@ class DataController:
             -> dict[str, str | None]:
         if data_module not in self.data_modules:
             raise HTTPException(404, "Data module not found")
-        if len(data) == 1:
-            data_id, value = list(data.items())[0]
-            return {
-                data_id: await self.data_modules[data_module]
-                .set_value(data_id, value),
-            }
-        return await self.data_modules[data_module] \
-            .set_value_multiple(data.items())
+        try:
+            if len(data) == 1:
+                data_id, value = list(data.items())[0]
+                return {
+                    data_id: await self.data_modules[data_module]
+                    .set_value(data_id, value),
+                }
+            return await self.data_modules[data_module] \
+                .set_value_multiple(data.items())
+        finally:
+            self.cache.invalidate(data_module, data.keys())
 
     async def register_cov(self, module: str, data_id: str, callback_id: str,
                            callback: COVCallback) -> bool:
+        """
+        Subscribes callback to COV messages of data_id. All subscribers of a
+        point share a single subscription in the module, which is kept for
+        the acquisition grace period after the last subscriber is removed.
+        """
         if not module or module not in self.data_modules:
             raise HTTPException(404, "Data module not found")
-        return await self.data_modules[module].register_cov(data_id,
-                                                            callback_id,
-                                                            callback)
+        point = (module, data_id)
+        acquisition = self._covs.get(point)
+        if acquisition is None:
+            acquisition = _COVAcquisition()
+            self._covs[point] = acquisition
+            registered = asyncio.create_task(
+                self._register_module_cov(point, acquisition),
+            )
+            acquisition.registered = registered
+        else:
+            registered = cast(asyncio.Task[bool], acquisition.registered)
+        try:
+            if not await asyncio.shield(registered):
+                return False
+        except asyncio.CancelledError:
+            # The subscription may be left without any subscribers
+            registered.add_done_callback(
+                lambda _: self._release_unused_cov(point, acquisition),
+            )
+            raise
+        if acquisition.release is not None:
+            acquisition.release.cancel()
+            acquisition.release = None
+        acquisition.callbacks[callback_id] = callback
+        # Values sent by the module before the subscriber was added
+        for cached_id, value in self.cache.peek(module, (data_id,)).items():
+            await DataModule.call_covs(cached_id, value, (callback,), _logger)
+        return True
+
+    async def _register_module_cov(self, point: tuple[str, str],
+                                   acquisition: _COVAcquisition) -> bool:
+        module, data_id = point
+
+        async def cov_callback(cov_data_id: str,
+                               value: str | list[str]) -> None:
+            self.cache.update(module, cov_data_id, value)
+            if cov_data_id != data_id:
+                self.cache.invalidate(module, (data_id,))
+            await DataModule.call_covs(cov_data_id, value,
+                                       list(acquisition.callbacks.values()),
+                                       _logger)
+
+        try:
+            registered = await self.data_modules[module].register_cov(
+                data_id, acquisition.callback_id, cov_callback,
+            )
+        except BaseException:
+            del self._covs[point]
+            raise
+        if not registered:
+            del self._covs[point]
+            return False
+        _logger.debug("Acquired COV of %r", point)
+        self._acquired += 1
+        return True
 
     async def remove_cov(self, module: str, data_id: str, callback_id: str) \
             -> None:
         if not module or module not in self.data_modules:
             raise HTTPException(404, "Data module not found")
-        return await self.data_modules[module].remove_cov(data_id, callback_id)
+        point = (module, data_id)
+        acquisition = self._covs.get(point)
+        if acquisition is None or callback_id not in acquisition.callbacks:
+            return
+        del acquisition.callbacks[callback_id]
+        if acquisition.callbacks:
+            return
+        if self.acquisition.grace_period <= 0:
+            await self._release_cov(point, acquisition)
+            return
+        self._release_unused_cov(point, acquisition)
+
+    def _release_unused_cov(self, point: tuple[str, str],
+                            acquisition: _COVAcquisition) -> None:
+        """Releases acquisition after the grace period if it is unused"""
+        if self._covs.get(point) is not acquisition or acquisition.callbacks \
+                or acquisition.release is not None:
+            return
+        acquisition.release = asyncio.get_running_loop().call_later(
+            max(self.acquisition.grace_period, 0), self._schedule_release_cov,
+            point, acquisition,
+        )
+
+    def _schedule_release_cov(self, point: tuple[str, str],
+                              acquisition: _COVAcquisition) -> None:
+        task = asyncio.create_task(self._release_cov(point, acquisition))
+        self._release_tasks.add(task)
+        task.add_done_callback(self._release_tasks.discard)
+
+    async def _release_cov(self, point: tuple[str, str],
+                           acquisition: _COVAcquisition) -> None:
+        if self._covs.get(point) is not acquisition or acquisition.callbacks:
+            return
+        del self._covs[point]
+        _logger.debug("Releasing COV of %r", point)
+        self._released += 1
+        module, data_id = point
+        await self.data_modules[module].remove_cov(data_id,
+                                                   acquisition.callback_id)
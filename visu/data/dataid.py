@@ -0,0 +1,44 @@
+"""Lookup of data ids parsed into module specific handles"""
+import logging
+from sys import intern
+from typing import Callable, Generic, Iterable, TypeVar
+
+from fastapi.exceptions import HTTPException
+
+
+# Data ids received over the API are not remembered above this limit
+MAX_DATA_IDS = 10000
+
+_logger = logging.getLogger(__name__)
+
+_H = TypeVar("_H")
+
+
+class DataIdLookup(Generic[_H]):
+    """
+    Parses each data id only once and keeps the parsed handle under the
+    interned data id string
+    """
+
+    def __init__(self, parse: Callable[[str], _H]) -> None:
+        self._parse = parse
+        self._handles: dict[str, _H] = {}
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+    def get(self, data_id: str) -> _H:
+        """Raises HTTPException(400) if the data_id is not valid"""
+        handle = self._handles.get(data_id)
+        if handle is None:
+            handle = self._parse(data_id)
+            if len(self._handles) < MAX_DATA_IDS:
+                self._handles[intern(data_id)] = handle
+        return handle
+
+    def compile(self, data_ids: Iterable[str]) -> None:
+        for data_id in data_ids:
+            try:
+                self.get(data_id)
+            except HTTPException as ex:
+                _logger.warning("Invalid data id %r: %r", data_id, ex.detail)
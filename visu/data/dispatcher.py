@@ -0,0 +1,128 @@
+import asyncio
+import logging
+from typing import Hashable
+
+from .base import COVCallback
+
+
+_logger = logging.getLogger(__name__)
+
+
+class _Subscriber:
+    def __init__(self, callback: COVCallback, max_pending: int) -> None:
+        self.callback = callback
+        self.max_pending = max_pending
+        self.topics: set[Hashable] = set()
+        # Latest undelivered value of each data id in order of arrival
+        self.pending: dict[str, str | list[str]] = {}
+        self.event = asyncio.Event()
+        self.delivered = 0
+        self.dropped = 0
+        self.task = asyncio.create_task(self._deliver())
+
+    def put(self, data_id: str, value: str | list[str]) -> None:
+        if data_id in self.pending:
+            # Only the latest value is delivered
+            del self.pending[data_id]
+            self.dropped += 1
+        elif len(self.pending) >= self.max_pending:
+            del self.pending[next(iter(self.pending))]
+            self.dropped += 1
+        self.pending[data_id] = value
+        self.event.set()
+
+    async def _deliver(self) -> None:
+        while True:
+            await self.event.wait()
+            self.event.clear()
+            while self.pending:
+                data_id = next(iter(self.pending))
+                value = self.pending.pop(data_id)
+                try:
+                    res = self.callback(data_id, value)
+                    if res is not None:
+                        await res
+                    self.delivered += 1
+                except Exception as ex:
+                    _logger.warning("Exception while calling cov %r", ex)
+
+
+class COVDispatcher:
+    """
+    Delivers COV values to subscribers without blocking the producer.
+
+    Each subscriber has its own bounded queue keeping only the latest value
+    of each data id and its own task calling its callback, so a slow
+    subscriber delays only itself.
+    """
+
+    def __init__(self, max_pending: int = 100) -> None:
+        self.max_pending = max_pending
+        self._subscribers: dict[str, _Subscriber] = {}
+        self._topics: dict[Hashable, set[str]] = {}
+        self._delivered = 0
+        self._dropped = 0
+
+    def add(self, topic: Hashable, callback_id: str,
+            callback: COVCallback) -> None:
+        if callback_id not in self._subscribers:
+            self._subscribers[callback_id] = \
+                _Subscriber(callback, self.max_pending)
+        self._subscribers[callback_id].topics.add(topic)
+        if topic not in self._topics:
+            self._topics[topic] = set()
+        self._topics[topic].add(callback_id)
+
+    def remove(self, topic: Hashable, callback_id: str) -> None:
+        if topic in self._topics:
+            self._topics[topic].discard(callback_id)
+            if not self._topics[topic]:
+                del self._topics[topic]
+        subscriber = self._subscribers.get(callback_id)
+        if subscriber is None:
+            return
+        subscriber.topics.discard(topic)
+        if not subscriber.topics:
+            subscriber.task.cancel()
+            self._delivered += subscriber.delivered
+            self._dropped += subscriber.dropped
+            del self._subscribers[callback_id]
+
+    def has(self, topic: Hashable, callback_id: str | None = None) -> bool:
+        if callback_id is None:
+            return topic in self._topics
+        return callback_id in self._topics.get(topic, ())
+
+    def topics(self) -> list[Hashable]:
+        return list(self._topics)
+
+    def send(self, callback_id: str, data_id: str,
+             value: str | list[str]) -> None:
+        """Queues value only for the subscriber with callback_id"""
+        if callback_id in self._subscribers:
+            self._subscribers[callback_id].put(data_id, value)
+
+    def dispatch(self, topic: Hashable, data_id: str,
+                 value: str | list[str]) -> None:
+        for callback_id in self._topics.get(topic, ()):
+            self._subscribers[callback_id].put(data_id, value)
+
+    async def stop(self) -> None:
+        for subscriber in self._subscribers.values():
+            subscriber.task.cancel()
+        self._subscribers.clear()
+        self._topics.clear()
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "subscribers": len(self._subscribers),
+            "topics": len(self._topics),
+            "pending": sum(len(subscriber.pending)
+                           for subscriber in self._subscribers.values()),
+            "delivered": self._delivered
+            + sum(subscriber.delivered
+                  for subscriber in self._subscribers.values()),
+            "dropped": self._dropped
+            + sum(subscriber.dropped
+                  for subscriber in self._subscribers.values()),
+        }
@@ -0,0 +1,186 @@
+"""Health tracking of remote devices shared by data modules"""
+import asyncio
+import logging
+from time import monotonic
+from typing import Awaitable, Iterable, TypeVar
+
+from fastapi.exceptions import HTTPException
+
+from .config import HealthConfig
+
+
+# Value of data ids on devices which are not available
+UNAVAILABLE = "unavailable"
+
+_logger = logging.getLogger(__name__)
+
+_T = TypeVar("_T")
+
+
+class DeviceUnavailable(HTTPException):
+    def __init__(self, device: str, reason: object = "circuit open") -> None:
+        super().__init__(503, f"Device {device} unavailable: {reason}")
+        self.device = device
+
+
+def unavailable(data_ids: Iterable[str]) -> dict[str, str | list[str]]:
+    return {data_id: UNAVAILABLE for data_id in data_ids}
+
+
+class DeviceHealth:
+    """
+    Round trip time estimate and circuit breaker of a single device.
+
+    Requests time out after the smoothed RTT plus four times its variance
+    (as in RFC 6298), at least the configured min_timeout and at most
+    max_timeout, but never before the min_timeout of the device. After
+    failure_threshold consecutive failures the circuit opens and requests
+    fail immediately until open_time passes, then a single probe request is
+    let through, which closes the circuit on success or opens it again for
+    twice as long on failure.
+    """
+
+    def __init__(self, name: str, config: HealthConfig,
+                 max_timeout: float, min_timeout: float = 0) -> None:
+        self.name = name
+        self.config = config
+        self.max_timeout = max_timeout
+        self.min_timeout = min_timeout
+        self._srtt: float | None = None
+        self._rttvar = 0.0
+        self._backoff = 1
+        self._failures = 0
+        self._open_time = config.open_time
+        self._open_until = 0.0
+        self._probing = False
+
+        self._successes = 0
+        self._failures_total = 0
+        self._rejected = 0
+
+    @property
+    def open(self) -> bool:
+        return 0 < self.config.failure_threshold <= self._failures
+
+    def timeout(self) -> float:
+        if self._srtt is None:
+            return max(self.max_timeout, self.min_timeout)
+        return max(min(max(self._srtt + 4 * self._rttvar,
+                           self.config.min_timeout) * self._backoff,
+                       self.max_timeout),
+                   self.min_timeout)
+
+    def get_stats(self) -> dict[str, object]:
+        return {
+            "state": ("half-open" if self._probing else "open")
+            if self.open else "closed",
+            "rtt": self._srtt,
+            "timeout": self.timeout(),
+            "successes": self._successes,
+            "failures": self._failures_total,
+            "rejected": self._rejected,
+        }
+
+    def acquire(self) -> bool:
+        """
+        Raises DeviceUnavailable if the circuit is open, starts the probe
+        if it is time for one.
+
+        Returns True if the request is the probe.
+        """
+        if not self.open:
+            return False
+        if self._probing or monotonic() < self._open_until:
+            self._rejected += 1
+            raise DeviceUnavailable(self.name)
+        _logger.debug("Probing device %r", self.name)
+        self._probing = True
+        return True
+
+    def release(self, probe: bool) -> None:
+        """Ends a request that neither succeeded nor failed"""
+        if probe:
+            self._probing = False
+
+    def success(self, rtt: float) -> None:
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - rtt)
+            self._srtt = 0.875 * self._srtt + 0.125 * rtt
+        if self.open:
+            _logger.info("Device %r is available again", self.name)
+        self._successes += 1
+        self._backoff = 1
+        self._failures = 0
+        self._open_time = self.config.open_time
+        self._probing = False
+
+    def failure(self, probe: bool = False) -> None:
+        self._failures_total += 1
+        self._failures += 1
+        self._backoff = min(self._backoff * 2, 64)
+        if probe:
+            self._open_time = min(self._open_time * 2,
+                                  self.config.max_open_time)
+            self._probing = False
+        if self.open:
+            if self._failures == self.config.failure_threshold:
+                _logger.warning("Device %r is not available", self.name)
+            self._open_until = monotonic() + self._open_time
+
+    async def run(self, request: Awaitable[_T],
+                  failures: tuple[type[BaseException], ...] = (),
+                  probe: bool = False) -> _T:
+        """
+        Awaits request with the adaptive timeout and records the result,
+        probe is the value returned by acquire.
+
+        Raises DeviceUnavailable if it times out or raises one of failures,
+        other exceptions are passed through.
+        """
+        start = monotonic()
+        try:
+            result = await asyncio.wait_for(request, self.timeout())
+        except (asyncio.TimeoutError, *failures) as ex:
+            self.failure(probe)
+            raise DeviceUnavailable(
+                self.name,
+                "timeout" if isinstance(ex, asyncio.TimeoutError) else ex,
+            ) from ex
+        except BaseException:
+            self.release(probe)
+            raise
+        self.success(monotonic() - start)
+        return result
+
+    async def call(self, request: Awaitable[_T],
+                   failures: tuple[type[BaseException], ...] = ()) -> _T:
+        """Runs request if the circuit is not open"""
+        try:
+            probe = self.acquire()
+        except DeviceUnavailable:
+            if asyncio.iscoroutine(request):
+                request.close()
+            raise
+        return await self.run(request, failures, probe)
+
+
+class HealthTracker:
+    """Health of devices of a single data module"""
+
+    def __init__(self, config: HealthConfig) -> None:
+        self.config = config
+        self._devices: dict[str, DeviceHealth] = {}
+
+    def get(self, device: str, max_timeout: float,
+            min_timeout: float = 0) -> DeviceHealth:
+        if device not in self._devices:
+            self._devices[device] = DeviceHealth(device, self.config,
+                                                 max_timeout, min_timeout)
+        return self._devices[device]
+
+    def get_stats(self) -> dict[str, dict[str, object]]:
+        return {device: health.get_stats()
+                for device, health in self._devices.items()}
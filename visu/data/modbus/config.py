@@ -4,6 +4,9 @@ from pymodbus.constants import Defaults
 
 from tomlconfig import configclass
 
+from ..config import HealthConfig, PolledCOVConfig
+
+
 @configclass
 class ModbusConnectionSerialConfig:
     port: str = ""
@@ -27,6 +30,9 @@ class ModbusConnectionConfig:
     conn_id: str = ""
     timout: int = Defaults.Timeout
     retries: int = Defaults.Retries
+    idle_timeout: int = 60
+    max_transactions: int = 4
+    max_read_gap: int = 8
     tcp: ModbusConnectionTCPConfig | None = None
     serial: ModbusConnectionSerialConfig | None = None
 
@@ -34,3 +40,5 @@ class ModbusConnectionConfig:
 @configclass
 class ModbusDataModuleConfig:
     conn: list[ModbusConnectionConfig] = field(default_factory=list)
+    cov: PolledCOVConfig = field(default_factory=PolledCOVConfig)
+    health: HealthConfig = field(default_factory=HealthConfig)
@@ -1,165 +1,302 @@
+import asyncio
 import logging
 import re
-from typing import Pattern
+from typing import Awaitable, Callable, Iterable
 
 from fastapi.exceptions import HTTPException
 from pymodbus.bit_read_message import ReadCoilsResponse, ReadDiscreteInputsResponse
 from pymodbus.bit_write_message import WriteSingleCoilResponse
 from pymodbus.client import AsyncModbusSerialClient, AsyncModbusTcpClient
 from pymodbus.exceptions import ModbusException
-from pymodbus.framer.ascii_framer import ModbusAsciiFramer
-from pymodbus.framer.rtu_framer import ModbusRtuFramer
-from pymodbus.framer.socket_framer import ModbusSocketFramer
-from pymodbus.pdu import ExceptionResponse
+from pymodbus.pdu import ExceptionResponse, ModbusExceptions, ModbusResponse
 from pymodbus.register_read_message import (
     ReadHoldingRegistersResponse,
     ReadInputRegistersResponse,
 )
 from pymodbus.register_write_message import WriteSingleRegisterResponse
 
-from ..base import DataModule
-from .config import ModbusConnectionConfig, ModbusDataModuleConfig
+from tomlconfig import ConfigError
+
+from ..dataid import DataIdLookup
+from ..health import (
+    UNAVAILABLE, DeviceUnavailable, HealthTracker, unavailable,
+)
+from ..polled import PolledCOVDataModule
+from .config import ModbusDataModuleConfig
+from .planner import ReadBlock, plan_reads
+from .pool import ModbusConnection
+from .scheduler import SerialBusScheduler
 
 
-_DATA_ID_RD_RE = re.compile(r"^(?P<conn_id>\w+)"
-                            r"::(?P<slave>\d+)"
-                            r"::(?P<obj_type>co|di|hr|ir):(?P<addr>\d+)"
-                            r"(::?:(?P<count>\d+))?$")
-_DATA_ID_WR_RE = re.compile(r"^(?P<conn_id>\w+)"
-                            r"::(?P<slave>\d+)"
-                            r"::(?P<obj_type>co|hr):(?P<addr>\d+)"
-                            r"(::?:(?P<count>\d+))?$")
+_DATA_ID_RE = re.compile(r"^(?P<conn_id>\w+)"
+                         r"::(?P<slave>\d+)"
+                         r"::(?P<obj_type>co|di|hr|ir):(?P<addr>\d+)"
+                         r"(::?:(?P<count>\d+))?$")
+# Exceptions caused by an unreachable device
+_FAILURES = (ModbusException, OSError)
+_WRITABLE = ("co", "hr")
 _logger = logging.getLogger(__name__)
 
 
-def _build_client(config: ModbusConnectionConfig) \
-        -> AsyncModbusTcpClient | AsyncModbusSerialClient:
-    if config.tcp is not None:
-        return AsyncModbusTcpClient(
-            config.tcp.address,
-            config.tcp.port,
-            ModbusRtuFramer if config.tcp.rtu else ModbusSocketFramer,
-            timeout=config.timout,
-            retries=config.retries,
-        )
-    if config.serial is not None:
-        return AsyncModbusSerialClient(
-            config.serial.port,
-            ModbusAsciiFramer if config.serial.ascii else ModbusRtuFramer,
-            config.serial.baudrate,
-            config.serial.bytesize,
-            config.serial.parity,
-            config.serial.stopbits,
-            timeout=config.timout,
-            retries=config.retries,
-            handle_local_echo=config.serial.handle_local_echo,
-        )
-    assert False
+class ModbusErrorResponse(HTTPException):
+    """Exception response of a device to a request"""
+
+    def __init__(self, response: ExceptionResponse) -> None:
+        super().__init__(500, f"Modbus error: {response} "
+                              f"code: {response.exception_code}")
+        self.exception_code = response.exception_code
+
+
+class ModbusDataId:
+    __slots__ = ("conn_id", "slave", "obj_type", "addr", "count")
+
+    def __init__(self, conn_id: str, slave: int, obj_type: str, addr: int,
+                 count: int) -> None:
+        self.conn_id = conn_id
+        self.slave = slave
+        self.obj_type = obj_type
+        self.addr = addr
+        self.count = count
 
 
-class ModbusDataModule(DataModule):
+class ModbusDataModule(PolledCOVDataModule):
     name = "modbus"
 
     def __init__(self, config: ModbusDataModuleConfig) -> None:
-        self._conns = {conn.conn_id: conn for conn in config.conn}
+        super().__init__(config.cov)
+        self._schedulers: dict[str, SerialBusScheduler] = {}
+        # conn_ids on the same serial port share its connection
+        self._conns: dict[str, ModbusConnection] = {}
+        serial_conns: dict[str, ModbusConnection] = {}
+        for conn in config.conn:
+            if conn.conn_id in self._conns:
+                raise ConfigError("Duplicate Modbus connection id: "
+                                  f"{conn.conn_id}")
+            if conn.tcp is not None or conn.serial is None:
+                self._conns[conn.conn_id] = ModbusConnection(conn)
+                continue
+            port = conn.serial.port
+            if port not in serial_conns:
+                self._schedulers[port] = SerialBusScheduler(conn.serial)
+                serial_conns[port] = ModbusConnection(conn,
+                                                      self._schedulers[port])
+            shared = serial_conns[port].config
+            if (conn.serial, conn.timout, conn.retries) \
+                    != (shared.serial, shared.timout, shared.retries):
+                raise ConfigError(f"Modbus connections {shared.conn_id} and "
+                                  f"{conn.conn_id} use serial port {port} "
+                                  "with different settings")
+            self._conns[conn.conn_id] = serial_conns[port]
+        self._max_read_gaps = {conn.conn_id: conn.max_read_gap
+                               for conn in config.conn}
+        self._idle_task: asyncio.Task[None] | None = None
+        self._health = HealthTracker(config.health)
+        self._data_ids = DataIdLookup(self._parse_data_id)
 
-    def _parse_data_id(self, data_id: str, data_id_re: Pattern[str]) \
-            -> tuple[str, int, str, int, int]:
-        data = data_id_re.match(data_id)
+    async def start(self) -> None:
+        await super().start()
+        self._idle_task = asyncio.create_task(self._close_idle())
+
+    async def stop(self) -> None:
+        await super().stop()
+        if self._idle_task is not None:
+            self._idle_task.cancel()
+        for conn in set(self._conns.values()):
+            await conn.close()
+
+    def get_stats(self) -> dict[str, object]:
+        return {
+            **super().get_stats(),
+            "health": self._health.get_stats(),
+            "serial": {port: scheduler.get_stats()
+                       for port, scheduler in self._schedulers.items()},
+        }
+
+    async def _close_idle(self) -> None:
+        while True:
+            await asyncio.sleep(1)
+            for conn in set(self._conns.values()):
+                if conn.idle:
+                    await conn.close()
+
+    def compile_data_ids(self, data_ids: Iterable[str]) -> None:
+        self._data_ids.compile(data_ids)
+
+    @staticmethod
+    def _parse_data_id(data_id: str) -> ModbusDataId:
+        data = _DATA_ID_RE.match(data_id)
         if data is None:
             raise HTTPException(400, "Invalid data id")
         count = data.group("count")
-        return data.group("conn_id"), int(data.group("slave")), \
-            data.group("obj_type"), int(data.group("addr")), \
-            int(count) if count is not None else 1
+        return ModbusDataId(data.group("conn_id"), int(data.group("slave")),
+                            data.group("obj_type"), int(data.group("addr")),
+                            int(count) if count is not None else 1)
 
-    def _parse_data_id_read(self, data_id: str) \
-            -> tuple[str, int, str, int, int]:
-        return self._parse_data_id(data_id, _DATA_ID_RD_RE)
+    def _parse_data_id_read(self, data_id: str) -> ModbusDataId:
+        return self._data_ids.get(data_id)
 
-    def _parse_data_id_write(self, data_id: str) \
-            -> tuple[str, int, str, int, int]:
-        return self._parse_data_id(data_id, _DATA_ID_WR_RE)
+    def _parse_data_id_write(self, data_id: str) -> ModbusDataId:
+        handle = self._data_ids.get(data_id)
+        if handle.obj_type not in _WRITABLE:
+            raise HTTPException(400, "Invalid data id")
+        return handle
 
-    async def get_value(self, data_id: str) -> str | list[str]:
-        client: AsyncModbusTcpClient | AsyncModbusSerialClient | None = None
+    async def _transaction(
+            self, conn_id: str, slave: int, write: bool,
+            request: Callable[[AsyncModbusTcpClient
+                               | AsyncModbusSerialClient],
+                              Awaitable[ModbusResponse]],
+    ) -> ModbusResponse:
+        conn = self._conns[conn_id]
+        # Requests are not cut short before the client gives up retrying
+        client_timeout = conn.config.timout * (conn.config.retries + 1)
+        health = self._health.get(f"{conn_id}::{slave}", client_timeout,
+                                  client_timeout)
+        probe = health.acquire()
+        started = False
         try:
-            conn_id, slave, obj_type, addr, count = \
-                self._parse_data_id_read(data_id)
-            if conn_id not in self._conns:
-                raise HTTPException(404, "Connection id not found")
-            _logger.debug("Get conn=%r slave=%r addr=%r count=%r", conn_id,
-                          slave, addr, count)
-            client = _build_client(self._conns[conn_id])
-            await client.connect()
-            res = await {
+            async with conn.transaction(write) as client:
+                started = True
+                return await health.run(request(client), _FAILURES, probe)
+        except _FAILURES as ex:
+            if started:
+                raise
+            # Could not connect
+            health.failure(probe)
+            raise DeviceUnavailable(health.name, ex) from ex
+        finally:
+            if not started:
+                health.release(probe)
+
+    async def _read(self, conn_id: str, slave: int, obj_type: str,
+                    addr: int, count: int, request: str) \
+            -> list[bool] | list[int]:
+        if conn_id not in self._conns:
+            raise HTTPException(404, "Connection id not found")
+        _logger.debug("Get conn=%r slave=%r addr=%r count=%r", conn_id,
+                      slave, addr, count)
+        res = await self._transaction(
+            conn_id, slave, False,
+            lambda client: {
                 "co": client.read_coils,
                 "di": client.read_discrete_inputs,
                 "hr": client.read_holding_registers,
                 "ir": client.read_input_registers,
-            }[obj_type](addr, count, slave)
-            if isinstance(res, ExceptionResponse):
-                _logger.error("Error: %r code: %r while reading %r", res,
-                              res.exception_code, data_id)
-                raise HTTPException(500,
-                                    f"Modbus error: {res} "
-                                    f"code: {res.exception_code}")
-            if isinstance(res, (ReadCoilsResponse,
-                                ReadDiscreteInputsResponse)):
-                value = res.bits
-            elif isinstance(res, (ReadHoldingRegistersResponse,
-                                  ReadInputRegistersResponse)):
-                value = res.registers
+            }[obj_type](addr, count, slave),
+        )
+        if isinstance(res, ExceptionResponse):
+            _logger.error("Error: %r code: %r while reading %r", res,
+                          res.exception_code, request)
+            raise ModbusErrorResponse(res)
+        if isinstance(res, (ReadCoilsResponse,
+                            ReadDiscreteInputsResponse)):
+            return res.bits[:count]
+        if isinstance(res, (ReadHoldingRegistersResponse,
+                            ReadInputRegistersResponse)):
+            return res.registers[:count]
+        _logger.error("Invalid response from Modbus")
+        raise HTTPException(500, "Invalid response from Modbus")
+
+    @staticmethod
+    def _format_value(value: list[bool] | list[int]) -> str | list[str]:
+        return list(map(str, value)) if len(value) > 1 else str(value[0])
+
+    async def get_value(self, data_id: str) -> str | list[str]:
+        handle = self._parse_data_id_read(data_id)
+        return self._format_value(await self._read(
+            handle.conn_id, handle.slave, handle.obj_type, handle.addr,
+            handle.count, data_id,
+        ))
+
+    async def _read_block(self, block: ReadBlock) \
+            -> dict[str, str | list[str]]:
+        try:
+            values = await self._read(block.conn_id, block.slave,
+                                      block.obj_type, block.addr, block.count,
+                                      f"{block.conn_id}::{block.slave}::"
+                                      f"{block.obj_type}:{block.addr}::"
+                                      f"{block.count}")
+        except DeviceUnavailable:
+            return unavailable(data_id for data_id, _, _ in block.members)
+        except ModbusErrorResponse as ex:
+            if len(block.members) == 1 \
+                    or ex.exception_code != ModbusExceptions.IllegalAddress:
+                raise
+            # The gap between requested addresses may contain addresses the
+            # device refuses to read, fall back to separate reads
+            return await self._read_members(block)
+        return {data_id: self._format_value(value)
+                for data_id, value in block.split(values)}
+
+    async def _read_members(self, block: ReadBlock) \
+            -> dict[str, str | list[str]]:
+        data_ids = [data_id for data_id, _, _ in block.members]
+        result: dict[str, str | list[str]] = {}
+        for data_id, value in zip(data_ids, await asyncio.gather(
+            *map(self.get_value, data_ids), return_exceptions=True,
+        )):
+            # A failed member does not hide the values of the others
+            if isinstance(value, DeviceUnavailable):
+                result[data_id] = UNAVAILABLE
+            elif isinstance(value, HTTPException):
+                result[data_id] = str(value.detail)
+            elif isinstance(value, BaseException):
+                raise value
             else:
-                _logger.error("Invalid response from Modbus")
-                raise HTTPException(500, "Invalid response from Modbus")
-            return list(map(str, value)) if count > 1 else str(value[0])
-        except ModbusException as ex:
-            _logger.error("Exception: %r while reading %r", ex, data_id)
-            raise HTTPException(500, f"Modbus exception: {ex}") from ex
-        finally:
-            if client is not None:
-                await client.close()
+                result[data_id] = value
+        return result
+
+    async def get_value_multiple(self, data_ids: Iterable[str]) \
+            -> dict[str, str | list[str]]:
+        reads: dict[str, tuple[str, str, int, str, int, int]] = {}
+        for data_id in data_ids:
+            handle = self._parse_data_id_read(data_id)
+            reads[data_id] = (data_id, handle.conn_id, handle.slave,
+                              handle.obj_type, handle.addr, handle.count)
+        blocks = plan_reads(reads.values(), self._max_read_gaps)
+        _logger.debug("Coalesced %r reads into %r requests", len(reads),
+                      len(blocks))
+        result: dict[str, str | list[str]] = {}
+        for values in await asyncio.gather(*(self._read_block(block)
+                                             for block in blocks)):
+            result.update(values)
+        return result
 
     async def set_value(self, data_id: str, value: str) -> str | None:
-        client: AsyncModbusTcpClient | AsyncModbusSerialClient | None = None
         try:
-            conn_id, slave, obj_type, addr, count = \
-                self._parse_data_id_write(data_id)
-            if count != 1:
+            handle = self._parse_data_id_write(data_id)
+            conn_id, slave, obj_type, addr = \
+                handle.conn_id, handle.slave, handle.obj_type, handle.addr
+            if handle.count != 1:
                 raise HTTPException(400, "Cannot write multiple values")
             if conn_id not in self._conns:
                 raise HTTPException(404, "Connection id not found")
             _logger.debug("Set conn=%r slave=%r addr=%r value=%r", conn_id,
                           slave, addr, value)
-            client = _build_client(self._conns[conn_id])
-            await client.connect()
             if obj_type == "co":
-                res = await client.write_coil(addr,
-                                              value.lower() in ("true", "1"),
-                                              slave)
+                coil = value.lower() in ("true", "1")
+                res = await self._transaction(
+                    conn_id, slave, True,
+                    lambda client: client.write_coil(addr, coil, slave),
+                )
             elif obj_type == "hr":
-                res = await client.write_register(addr, int(value), slave)
+                register = int(value)
+                res = await self._transaction(
+                    conn_id, slave, True,
+                    lambda client: client.write_register(addr, register,
+                                                         slave),
+                )
             else:
                 assert False
             if isinstance(res, ExceptionResponse):
                 _logger.error("Error: %r code: %r while writing %r=%r", res,
                               res.exception_code, data_id, value)
-                raise HTTPException(500,
-                                    f"Modbus error: {res} "
-                                    f"code: {res.exception_code}")
+                raise ModbusErrorResponse(res)
             if isinstance(res, WriteSingleCoilResponse):
                 return str(res.value)
             if isinstance(res, WriteSingleRegisterResponse):
                 return str(res.value)
             _logger.error("Invalid response from Modbus")
             raise HTTPException(500, "Invalid response from Modbus")
-        except ModbusException as ex:
-            _logger.error("Exception: %r while writing %r=%r", ex, data_id,
-                          value)
-            raise HTTPException(500, f"Modbus exception: {ex}") from ex
         except ValueError as ex:
             raise HTTPException(400, "Invalid value: {ex}") from ex
-        finally:
-            if client is not None:
-                await client.close()
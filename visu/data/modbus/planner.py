@@ -0,0 +1,63 @@
+from dataclasses import dataclass, field
+from typing import Iterable
+
+
+READ_LIMITS = {
+    "co": 2000,
+    "di": 2000,
+    "hr": 125,
+    "ir": 125,
+}
+
+
+@dataclass
+class ReadBlock:
+    conn_id: str
+    slave: int
+    obj_type: str
+    addr: int
+    count: int
+    members: list[tuple[str, int, int]] = field(default_factory=list)
+
+    @property
+    def end(self) -> int:
+        return self.addr + self.count
+
+    def split(self, values: list[bool] | list[int]) \
+            -> Iterable[tuple[str, list[bool] | list[int]]]:
+        """Splits values read by the block back to the member data ids"""
+        for data_id, addr, count in self.members:
+            yield data_id, values[addr - self.addr:addr - self.addr + count]
+
+
+def plan_reads(reads: Iterable[tuple[str, str, int, str, int, int]],
+               max_gap: dict[str, int]) -> list[ReadBlock]:
+    """
+    Merges reads (data_id, conn_id, slave, obj_type, addr, count) of
+    adjacent or nearly adjacent addresses into blocks.
+
+    Reads on the same connection, slave and object type are merged when there
+    are at most max_gap[conn_id] unrequested addresses between them and the
+    merged block fits into the protocol limit of the object type.
+    """
+    groups: dict[tuple[str, int, str], list[tuple[str, int, int]]] = {}
+    for data_id, conn_id, slave, obj_type, addr, count in reads:
+        key = (conn_id, slave, obj_type)
+        if key not in groups:
+            groups[key] = []
+        groups[key].append((data_id, addr, count))
+
+    blocks: list[ReadBlock] = []
+    for (conn_id, slave, obj_type), members in groups.items():
+        limit = READ_LIMITS[obj_type]
+        gap = max_gap.get(conn_id, 0)
+        block: ReadBlock | None = None
+        for data_id, addr, count in sorted(members, key=lambda m: m[1]):
+            if block is not None and addr <= block.end + gap \
+                    and max(block.end, addr + count) - block.addr <= limit:
+                block.count = max(block.end, addr + count) - block.addr
+            else:
+                block = ReadBlock(conn_id, slave, obj_type, addr, count)
+                blocks.append(block)
+            block.members.append((data_id, addr, count))
+    return blocks
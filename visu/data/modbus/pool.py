@@ -0,0 +1,124 @@
+import asyncio
+from contextlib import AsyncExitStack, asynccontextmanager
+import logging
+from time import monotonic
+from typing import AsyncIterator
+
+from pymodbus.client import AsyncModbusSerialClient, AsyncModbusTcpClient
+from pymodbus.exceptions import ConnectionException, ModbusException
+from pymodbus.framer.ascii_framer import ModbusAsciiFramer
+from pymodbus.framer.rtu_framer import ModbusRtuFramer
+from pymodbus.framer.socket_framer import ModbusSocketFramer
+
+from ..health import DeviceUnavailable
+from .config import ModbusConnectionConfig
+from .scheduler import SerialBusScheduler
+
+
+_logger = logging.getLogger(__name__)
+
+
+def _build_client(config: ModbusConnectionConfig) \
+        -> AsyncModbusTcpClient | AsyncModbusSerialClient:
+    if config.tcp is not None:
+        return AsyncModbusTcpClient(
+            config.tcp.address,
+            config.tcp.port,
+            ModbusRtuFramer if config.tcp.rtu else ModbusSocketFramer,
+            timeout=config.timout,
+            retries=config.retries,
+        )
+    if config.serial is not None:
+        return AsyncModbusSerialClient(
+            config.serial.port,
+            ModbusAsciiFramer if config.serial.ascii else ModbusRtuFramer,
+            config.serial.baudrate,
+            config.serial.bytesize,
+            config.serial.parity,
+            config.serial.stopbits,
+            timeout=config.timout,
+            retries=config.retries,
+            handle_local_echo=config.serial.handle_local_echo,
+        )
+    assert False
+
+
+class ModbusConnection:
+    """
+    Long-lived Modbus client for a single conn_id, or all conn_ids on the
+    same serial port, which is (re)connected on demand and limits the number
+    of concurrent transactions
+    """
+
+    def __init__(self, config: ModbusConnectionConfig,
+                 scheduler: SerialBusScheduler | None = None) -> None:
+        self.config = config
+        self.scheduler = scheduler
+        self._client: AsyncModbusTcpClient | AsyncModbusSerialClient | None \
+            = None
+        self._connect_lock = asyncio.Lock()
+        self._transactions = asyncio.Semaphore(
+            1 if config.tcp is None else max(config.max_transactions, 1),
+        )
+        self._active = 0
+        self._last_used = monotonic()
+
+    @property
+    def idle(self) -> bool:
+        return self._active == 0 \
+            and monotonic() - self._last_used > self.config.idle_timeout
+
+    async def _get_client(self) \
+            -> AsyncModbusTcpClient | AsyncModbusSerialClient:
+        async with self._connect_lock:
+            if self._client is not None and self._client.connected:
+                return self._client
+            if self._client is not None:
+                await self._client.close()
+            _logger.debug("Connecting conn=%r", self.config.conn_id)
+            self._client = _build_client(self.config)
+            await self._client.connect()
+            if not self._client.connected:
+                await self._client.close()
+                self._client = None
+                raise ConnectionException(
+                    f"Could not connect {self.config.conn_id}",
+                )
+            return self._client
+
+    @asynccontextmanager
+    async def transaction(self, write: bool = False) \
+            -> AsyncIterator[AsyncModbusTcpClient | AsyncModbusSerialClient]:
+        """
+        Yields a connected client, the connection is dropped if the
+        transaction fails so the next one reconnects.
+
+        Transactions on a serial connection are ordered by its bus scheduler,
+        where writes take priority over reads.
+        """
+        async with AsyncExitStack() as stack:
+            if self.scheduler is not None:
+                await stack.enter_async_context(self.scheduler.slot(write))
+            else:
+                await stack.enter_async_context(self._transactions)
+            self._active += 1
+            try:
+                yield await self._get_client()
+            # Failures of requests run by a device health are raised as
+            # DeviceUnavailable
+            except (ModbusException, OSError, asyncio.TimeoutError,
+                    DeviceUnavailable):
+                await self.close()
+                raise
+            finally:
+                self._active -= 1
+                self._last_used = monotonic()
+
+    async def close(self) -> None:
+        async with self._connect_lock:
+            if self._client is None:
+                return
+            _logger.debug("Closing conn=%r", self.config.conn_id)
+            client = self._client
+            self._client = None
+            await client.close()
@@ -0,0 +1,102 @@
+import asyncio
+from contextlib import asynccontextmanager
+from heapq import heappop, heappush
+from itertools import count
+import logging
+from time import monotonic
+from typing import AsyncIterator
+
+from .config import ModbusConnectionSerialConfig
+
+
+_logger = logging.getLogger(__name__)
+
+PRIORITY_WRITE = 0
+PRIORITY_READ = 1
+
+
+def _frame_delay(config: ModbusConnectionSerialConfig) -> float:
+    if config.baudrate > 19200:
+        # Modbus over serial line specification recommends fixed 1.75 ms
+        # inter-frame delay for baudrates higher than 19200
+        return 0.00175
+    char_bits = 1 + config.bytesize + (0 if config.parity == "N" else 1) \
+        + config.stopbits
+    return 3.5 * char_bits / config.baudrate
+
+
+class SerialBusScheduler:
+    """
+    Orders transactions on a half-duplex serial port, so only one is on the
+    bus at a time, writes are sent before waiting reads and frames are
+    separated with an inter-frame delay
+    """
+
+    def __init__(self, config: ModbusConnectionSerialConfig) -> None:
+        self.port = config.port
+        self.frame_delay = _frame_delay(config)
+        self._queue: list[tuple[int, int, asyncio.Future[None]]] = []
+        self._order = count()
+        self._busy = False
+        self._last_frame = 0.0
+
+        self._max_depth = 0
+        self._transactions = [0, 0]
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def get_stats(self) -> dict[str, int | float]:
+        transactions = sum(self._transactions)
+        return {
+            "queue_depth": len(self._queue),
+            "max_queue_depth": self._max_depth,
+            "writes": self._transactions[PRIORITY_WRITE],
+            "reads": self._transactions[PRIORITY_READ],
+            "avg_wait": self._wait_total / transactions
+            if transactions else 0.0,
+            "max_wait": self._wait_max,
+        }
+
+    async def _acquire(self, priority: int) -> None:
+        if not self._busy:
+            self._busy = True
+            return
+        future: asyncio.Future[None] = \
+            asyncio.get_running_loop().create_future()
+        heappush(self._queue, (priority, next(self._order), future))
+        self._max_depth = max(self._max_depth, len(self._queue))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        while self._queue:
+            _, _, future = heappop(self._queue)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._busy = False
+
+    @asynccontextmanager
+    async def slot(self, write: bool = False) -> AsyncIterator[None]:
+        """Waits until the bus is free for a single transaction"""
+        priority = PRIORITY_WRITE if write else PRIORITY_READ
+        queued = monotonic()
+        await self._acquire(priority)
+        try:
+            wait = monotonic() - queued
+            self._transactions[priority] += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            _logger.debug("Serial port %r granted after %.3f s, %r waiting",
+                          self.port, wait, len(self._queue))
+            delay = self._last_frame + self.frame_delay - monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield
+        finally:
+            self._last_frame = monotonic()
+            self._release()
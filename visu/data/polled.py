@@ -0,0 +1,119 @@
+"""Change of value notifications emulated by polling"""
+import asyncio
+import logging
+from time import monotonic
+
+from .base import COVCallback, DataModule
+from .config import PolledCOVConfig
+from .dispatcher import COVDispatcher
+
+
+_logger = logging.getLogger(__name__)
+
+
+class PolledCOVDataModule(DataModule):
+    """
+    Base of data modules without native change of value notifications,
+    which polls data ids with registered COV callbacks and calls them only
+    when the value changes by more than the configured deadband
+    """
+
+    def __init__(self, cov_config: PolledCOVConfig) -> None:
+        self.cov_config = cov_config
+        self.cov_dispatcher = COVDispatcher()
+        # Last value sent to the subscribers of each data id
+        self._cov_values: dict[str, str | list[str]] = {}
+        self._cov_task: asyncio.Task[None] | None = None
+        self._cov_polls = 0
+        self._cov_changes = 0
+        self._cov_suppressed = 0
+
+    async def start(self) -> None:
+        if self.cov_config.interval > 0:
+            self._cov_task = asyncio.create_task(self._cov_poll_loop())
+
+    async def stop(self) -> None:
+        if self._cov_task is not None:
+            self._cov_task.cancel()
+        await self.cov_dispatcher.stop()
+        self._cov_values.clear()
+
+    def get_stats(self) -> dict[str, object]:
+        return {
+            "cov": {
+                "polls": self._cov_polls,
+                "changes": self._cov_changes,
+                "suppressed": self._cov_suppressed,
+                **self.cov_dispatcher.get_stats(),
+            },
+        }
+
+    async def register_cov(self, data_id: str, callback_id: str,
+                           callback: COVCallback) -> bool:
+        if self.cov_config.interval <= 0:
+            return False
+        self.cov_dispatcher.add(data_id, callback_id, callback)
+        if data_id in self._cov_values:
+            self.cov_dispatcher.send(callback_id, data_id,
+                                     self._cov_values[data_id])
+        return True
+
+    async def remove_cov(self, data_id: str, callback_id: str) -> None:
+        self.cov_dispatcher.remove(data_id, callback_id)
+        if not self.cov_dispatcher.has(data_id):
+            self._cov_values.pop(data_id, None)
+
+    def _cov_changed(self, data_id: str, value: str | list[str]) -> bool:
+        if data_id not in self._cov_values:
+            return True
+        previous = self._cov_values[data_id]
+        if previous == value:
+            return False
+        if not isinstance(value, str) or not isinstance(previous, str):
+            return True
+        try:
+            new_value = float(value)
+            old_value = float(previous)
+        except ValueError:
+            return True
+        delta = abs(new_value - old_value)
+        return delta > self.cov_config.deadband \
+            and delta > abs(old_value) * self.cov_config.relative_deadband
+
+    async def _cov_poll(self, data_ids: list[str]) \
+            -> dict[str, str | list[str]]:
+        try:
+            return await self.get_value_multiple(data_ids)
+        except Exception as ex:
+            _logger.debug("Polling %r together failed, polling each: %r",
+                          data_ids, ex)
+        values: dict[str, str | list[str]] = {}
+        results = await asyncio.gather(*(self.get_value(data_id)
+                                         for data_id in data_ids),
+                                       return_exceptions=True)
+        for data_id, result in zip(data_ids, results):
+            if isinstance(result, BaseException):
+                _logger.warning("Exception while polling %r for COV: %r",
+                                data_id, result)
+                continue
+            values[data_id] = result
+        return values
+
+    async def _cov_poll_loop(self) -> None:
+        next_poll = monotonic()
+        while True:
+            data_ids = [str(data_id)
+                        for data_id in self.cov_dispatcher.topics()]
+            if data_ids:
+                self._cov_polls += 1
+                for data_id, value in (await self._cov_poll(data_ids)).items():
+                    if not self.cov_dispatcher.has(data_id):
+                        continue
+                    if not self._cov_changed(data_id, value):
+                        self._cov_suppressed += 1
+                        continue
+                    self._cov_changes += 1
+                    self._cov_values[data_id] = value
+                    self.cov_dispatcher.dispatch(data_id, data_id, value)
+            next_poll = max(next_poll + self.cov_config.interval, monotonic())
+            await asyncio.sleep(next_poll - monotonic())
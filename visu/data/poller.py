@@ -0,0 +1,158 @@
+"""Server-side polling of data values shared by all subscribers"""
+import asyncio
+from itertools import chain
+import logging
+from time import monotonic
+
+from fastapi.exceptions import HTTPException
+
+from .base import COVCallback, DataModule
+from .controller import DataController
+
+
+_logger = logging.getLogger(__name__)
+
+
+class DataPoller:
+    """
+    Polls each distinct (data_module, data_id) point once per the shortest
+    interval requested by its subscribers and pushes the values to all of
+    them, so device load does not grow with the number of viewers.
+
+    Points are polled only while they have subscribers and for the
+    acquisition grace period after the last one leaves, which keeps their
+    cached values fresh for viewers reloading a page.
+    """
+
+    def __init__(self, data_controller: DataController) -> None:
+        self._data_controller = data_controller
+        self._subscriptions: dict[tuple[str, str],
+                                  dict[str, tuple[int, bool,
+                                                  COVCallback]]] = {}
+        # (expires, interval, single) of points without subscribers
+        self._lingering: dict[tuple[str, str], tuple[float, int, bool]] = {}
+        self._tasks: dict[int, asyncio.Task[None]] = {}
+
+    async def stop(self) -> None:
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        self._subscriptions.clear()
+        self._lingering.clear()
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "points": len(self._subscriptions),
+            "subscribers": sum(map(len, self._subscriptions.values())),
+            "lingering": len(self._lingering),
+        }
+
+    def _point_interval(self, point: tuple[str, str]) -> int:
+        if point not in self._subscriptions:
+            return self._lingering[point][1]
+        return min(interval
+                   for interval, _, _ in self._subscriptions[point].values())
+
+    def _point_single(self, point: tuple[str, str]) -> bool:
+        if point not in self._subscriptions:
+            return self._lingering[point][2]
+        return any(single
+                   for _, single, _ in self._subscriptions[point].values())
+
+    def _ensure_task(self, interval: int) -> None:
+        if interval not in self._tasks:
+            _logger.debug("Starting poll loop with interval %r", interval)
+            self._tasks[interval] = \
+                asyncio.create_task(self._poll_loop(interval))
+
+    async def subscribe(self, data_module: str, data_id: str,
+                        subscriber_id: str, interval: int,
+                        callback: COVCallback, single: bool = False) -> None:
+        """
+        Subscribes callback to values of data_id polled at least every
+        interval seconds. Subscribing again with the same subscriber_id
+        replaces the previous subscription.
+
+        Raises HTTPException(404) if data_module is not found.
+        """
+        if data_module not in self._data_controller.data_modules:
+            raise HTTPException(404, "Data module not found")
+        point = (data_module, data_id)
+        self._lingering.pop(point, None)
+        if point not in self._subscriptions:
+            self._subscriptions[point] = {}
+        self._subscriptions[point][subscriber_id] = \
+            (max(interval, 1), single, callback)
+        self._ensure_task(self._point_interval(point))
+
+    async def unsubscribe(self, data_module: str, data_id: str,
+                          subscriber_id: str) -> None:
+        """Removes subscription created by subscribe"""
+        point = (data_module, data_id)
+        if point not in self._subscriptions \
+                or subscriber_id not in self._subscriptions[point]:
+            return
+        interval = self._point_interval(point)
+        single = self._point_single(point)
+        del self._subscriptions[point][subscriber_id]
+        if len(self._subscriptions[point]) == 0:
+            del self._subscriptions[point]
+            grace_period = self._data_controller.acquisition.grace_period
+            if grace_period > 0:
+                self._lingering[point] = (monotonic() + grace_period,
+                                          interval, single)
+        else:
+            self._ensure_task(self._point_interval(point))
+
+    async def _poll_loop(self, interval: int) -> None:
+        next_poll = monotonic()
+        while True:
+            now = monotonic()
+            for point, (expires, _, _) in list(self._lingering.items()):
+                if expires <= now:
+                    _logger.debug("Stopping polling of %r", point)
+                    del self._lingering[point]
+            points = [point
+                      for point in chain(self._subscriptions, self._lingering)
+                      if self._point_interval(point) == interval]
+            if not points:
+                _logger.debug("Stopping poll loop with interval %r", interval)
+                del self._tasks[interval]
+                return
+            await self._poll(points)
+            next_poll += interval
+            await asyncio.sleep(max(next_poll - monotonic(), 0))
+
+    async def _poll(self, points: list[tuple[str, str]]) -> None:
+        aggregated: dict[str, list[str]] = {}
+        requests: list[tuple[str, list[str]]] = []
+        for point in points:
+            data_module, data_id = point
+            if self._point_single(point):
+                requests.append((data_module, [data_id]))
+                continue
+            if data_module not in aggregated:
+                aggregated[data_module] = []
+            aggregated[data_module].append(data_id)
+        requests.extend(aggregated.items())
+        await asyncio.gather(*(self._poll_module(data_module, data_ids)
+                               for data_module, data_ids in requests))
+
+    async def _poll_module(self, data_module: str, data_ids: list[str]) \
+            -> None:
+        try:
+            values = await self._data_controller.get_values(data_module,
+                                                            data_ids)
+        except Exception as ex:
+            _logger.warning("Exception while polling %r %r: %r",
+                            data_module, data_ids, ex)
+            return
+        for data_id, value in values.items():
+            subscriptions = self._subscriptions.get((data_module, data_id))
+            if not subscriptions:
+                continue
+            await DataModule.call_covs(
+                data_id, value,
+                [callback for _, _, callback in subscriptions.values()],
+                _logger,
+            )
@@ -1,15 +1,28 @@
 from logging import getLogger
 from random import choice, randint, random
 from time import time
+from typing import Iterable
 from fastapi.exceptions import HTTPException
 
 from .base import COVCallback, DataModule
+from .dataid import DataIdLookup
 
 VALUE_TIMEOUT = 180
 
 _logger = getLogger(__name__)
 
 
+class RandomDataId:
+    __slots__ = ("name", "data_type", "value_min", "value_max")
+
+    def __init__(self, name: str, data_type: str, value_min: float,
+                 value_max: float) -> None:
+        self.name = name
+        self.data_type = data_type
+        self.value_min = value_min
+        self.value_max = value_max
+
+
 class RandomDataModule(DataModule):
     name = "random"
 
@@ -18,6 +31,7 @@ class RandomDataModule(DataModule):
         self.values: dict[str, tuple[float, str]] = {}
         self.cov_requests: dict[str, dict[str, COVCallback]] = {}
         self.running = False
+        self._data_ids = DataIdLookup(self._parse_handle)
 
     async def start(self) -> None:
         _logger.debug("Random data module started")
@@ -27,18 +41,29 @@ class RandomDataModule(DataModule):
         _logger.debug("Random data module stopped")
         self.running = False
 
-    def _parse_data_id(self, data_id: str) -> tuple[str, str, float, float]:
+    def compile_data_ids(self, data_ids: Iterable[str]) -> None:
+        self._data_ids.compile(data_ids)
+
+    @staticmethod
+    def _parse_handle(data_id: str) -> RandomDataId:
         data = data_id.split("::")
         if len(data) < 1:
             raise HTTPException(400, "Invalid data id")
         try:
-            return data[0], \
-                data[1] if len(data) > 1 else "int", \
-                float(data[2]) if len(data) > 2 else 0, \
-                float(data[3]) if len(data) > 3 else 100
+            return RandomDataId(
+                data[0],
+                data[1] if len(data) > 1 else "int",
+                float(data[2]) if len(data) > 2 else 0,
+                float(data[3]) if len(data) > 3 else 100,
+            )
         except (TypeError, ValueError) as ex:
             raise HTTPException(400, "Invalid data id") from ex
 
+    def _parse_data_id(self, data_id: str) -> tuple[str, str, float, float]:
+        handle = self._data_ids.get(data_id)
+        return handle.name, handle.data_type, handle.value_min, \
+            handle.value_max
+
     async def get_value(self, data_id: str) -> str:
         _logger.debug("get %r", data_id)
         name, data_type, value_min, value_max = self._parse_data_id(data_id)
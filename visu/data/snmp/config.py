@@ -19,6 +19,9 @@ from pysnmp.hlapi.asyncio import (
 
 from tomlconfig import configclass
 
+from ..config import HealthConfig, PolledCOVConfig
+
+
 @configclass
 class SNMPCommunityConfig:
     community_name: str = ""
@@ -95,6 +98,8 @@ class SNMPConnectionConfig:
     timeout: int = 1
     retries: int = 5
     ipv6: bool = False
+    max_varbinds: int = 32
+    max_repetitions: int = 25
     community_auth: SNMPCommunityConfig | None = None
     usm_auth: SNMPUsmConfig | None = None
 
@@ -102,3 +107,5 @@ class SNMPConnectionConfig:
 @configclass
 class SNMPDataModuleConfig:
     conn: list[SNMPConnectionConfig] = field(default_factory=list)
+    cov: PolledCOVConfig = field(default_factory=PolledCOVConfig)
+    health: HealthConfig = field(default_factory=HealthConfig)
@@ -1,6 +1,9 @@
+import asyncio
 import logging
+from typing import Any, Awaitable, Callable, Iterable
 
 from fastapi.exceptions import HTTPException
+from pysnmp.carrier.error import CarrierError
 from pysnmp.error import PySnmpError
 from pysnmp.hlapi.asyncio import (
     CommunityData,
@@ -10,24 +13,53 @@ from pysnmp.hlapi.asyncio import (
     SnmpEngine,
     Udp6TransportTarget,
     UdpTransportTarget,
+    bulkCmd,
     getCmd,
+    nextCmd,
     setCmd,
 )
 from pysnmp.hlapi.auth import UsmUserData
+from pysnmp.hlapi.varbinds import CommandGeneratorVarBinds
+from pysnmp.proto.rfc1902 import ObjectName
+from pysnmp.proto.rfc1905 import EndOfMibView
 
 from tomlconfig import ConfigError
 
-from ..base import DataModule
+from ..dataid import DataIdLookup
+from ..health import DeviceUnavailable, HealthTracker, unavailable
+from ..polled import PolledCOVDataModule
 from .config import SNMPConnectionConfig, SNMPDataModuleConfig
 
 
+_WALK = "walk"
+_NO_SUCH_INSTANCE = "No Such Instance currently exists at this OID"
+
 _logger = logging.getLogger(__name__)
 
 
-class SNMPDataModule(DataModule):
+class _EngineError(Exception):
+    pass
+
+
+class SNMPDataId:
+    __slots__ = ("conn_id", "obj_id", "table", "index")
+
+    def __init__(self, conn_id: str, obj_id: ObjectIdentity | None = None,
+                 table: tuple[str, ...] | None = None,
+                 index: str | None = None) -> None:
+        self.conn_id = conn_id
+        # Set for scalar data ids, resolved only once when first requested
+        self.obj_id = obj_id
+        # Set for walk data ids
+        self.table = table
+        self.index = index
+
+
+class SNMPDataModule(PolledCOVDataModule):
     name = "snmp"
 
     def __init__(self, config: SNMPDataModuleConfig) -> None:
+        super().__init__(config.cov)
         self._conns: dict[str, SNMPConnectionConfig] = {}
         for conn in config.conn:
             if conn.conn_id in self._conns:
@@ -44,12 +76,54 @@ class SNMPDataModule(DataModule):
                     with open(conn.usm_auth.priv_key_file, "r",
                               encoding="utf_8") as key_file:
                         conn.usm_auth.auth_key = key_file.read()
+        self._engine: SnmpEngine | None = None
+        self._context = ContextData()
+        self._auth_data: dict[str, CommunityData | UsmUserData] = {}
+        self._transports: dict[str, UdpTransportTarget
+                               | Udp6TransportTarget] = {}
+        self._walks: dict[tuple[str, tuple[str, ...]],
+                          asyncio.Task[dict[str, str]]] = {}
+        self._health = HealthTracker(config.health)
+        self._data_ids = DataIdLookup(self._parse_data_id)
 
-    def _parse_data_id(self, data_id: str) -> tuple[str, ObjectIdentity]:
+    async def start(self) -> None:
+        self._get_engine()
+        await super().start()
+
+    async def stop(self) -> None:
+        await super().stop()
+        if self._engine is not None \
+                and self._engine.transportDispatcher is not None:
+            self._engine.transportDispatcher.closeDispatcher()
+        self._engine = None
+        self._auth_data.clear()
+        self._transports.clear()
+
+    def get_stats(self) -> dict[str, object]:
+        return {
+            **super().get_stats(),
+            "health": self._health.get_stats(),
+        }
+
+    def _get_engine(self) -> SnmpEngine:
+        if self._engine is None:
+            self._engine = SnmpEngine()
+        return self._engine
+
+    def compile_data_ids(self, data_ids: Iterable[str]) -> None:
+        self._data_ids.compile(data_ids)
+
+    @staticmethod
+    def _parse_data_id(data_id: str) -> SNMPDataId:
         data = data_id.split("::")
+        if len(data) >= 3 and data[-1] == _WALK:
+            return SNMPDataId(data[0], table=tuple(data[1:-1]))
+        if len(data) >= 4 and data[-2] == _WALK:
+            return SNMPDataId(data[0], table=tuple(data[1:-2]),
+                              index=data[-1].lstrip("."))
         if len(data) < 2:
             raise HTTPException(400, "Invalid data id")
-        return data[0], ObjectIdentity(*data[1:])
+        return SNMPDataId(data[0], ObjectIdentity(*data[1:]))
 
     def _get_auth_data(self, conn: SNMPConnectionConfig) \
             -> CommunityData | UsmUserData:
@@ -75,52 +149,226 @@ class SNMPDataModule(DataModule):
         return transport_type((conn.address, conn.port), conn.timeout,
                               conn.retries)
 
-    async def get_value(self, data_id: str) -> str | list[str]:
-        conn_id, obj_id = self._parse_data_id(data_id)
+    async def _get_target(self, conn_id: str) \
+            -> tuple[CommunityData | UsmUserData,
+                     UdpTransportTarget | Udp6TransportTarget]:
         if conn_id not in self._conns:
             raise HTTPException(404, "SNMP connection not found")
+        if conn_id not in self._auth_data:
+            self._auth_data[conn_id] = \
+                self._get_auth_data(self._conns[conn_id])
+        if conn_id not in self._transports:
+            try:
+                # Address is resolved with a blocking getaddrinfo
+                transport = await asyncio.get_running_loop().run_in_executor(
+                    None, self._get_transport, self._conns[conn_id],
+                )
+                self._transports.setdefault(conn_id, transport)
+            except PySnmpError as ex:
+                _logger.error("Could not resolve %r: %r", conn_id, ex)
+                raise HTTPException(500, f"SNMP error: {ex}") from ex
+        return self._auth_data[conn_id], self._transports[conn_id]
 
-        _logger.debug("SNMP get conn=%r object=%r", conn_id, obj_id)
-        try:
-            engine_error, pdu_error, _, results = await getCmd(
-                SnmpEngine(),
-                self._get_auth_data(self._conns[conn_id]),
-                self._get_transport(self._conns[conn_id]),
-                ContextData(),
-                ObjectType(obj_id),
-            )
+    def _refresh_target(self, conn_id: str) -> None:
+        # Address is resolved again on the next request
+        self._transports.pop(conn_id, None)
+
+    async def _command(self, conn_id: str, command: Callable[..., Awaitable[
+            tuple[Any, Any, Any, Any]]], *args: Any) -> tuple[Any, Any, Any]:
+        """
+        Sends command to the connection conn_id and returns the PDU error,
+        error index and variable bindings of the response
+        """
+        auth_data, transport = await self._get_target(conn_id)
+        conn = self._conns[conn_id]
+        # Requests are not cut short before the engine gives up retrying
+        client_timeout = conn.timeout * (conn.retries + 1)
+        health = self._health.get(conn_id, client_timeout, client_timeout)
+
+        async def request() -> tuple[Any, Any, Any]:
+            try:
+                engine_error, pdu_error, error_index, var_binds = \
+                    await command(self._get_engine(), auth_data, transport,
+                                  self._context, *args)
+            except CarrierError:
+                # Transport of the target could not be set up
+                self._refresh_target(conn_id)
+                raise
             if engine_error:
-                raise HTTPException(500, f"SNMP Engine error: {engine_error}")
-            if pdu_error:
-                raise HTTPException(500, f"SNMP Pdu error: {pdu_error}")
-            if len(results) == 1:
-                return results[0][1].prettyPrint()
-            return list(map(lambda result: result[1].prettyPrint(), results))
+                raise _EngineError(engine_error)
+            return pdu_error, error_index, var_binds
+
+        try:
+            return await health.call(request(), (_EngineError,))
         except PySnmpError as ex:
             raise HTTPException(500, f"SNMP error: {ex}") from ex
 
-    async def set_value(self, data_id: str, value: str) -> str | None:
-        conn_id, obj_id = self._parse_data_id(data_id)
-        if conn_id not in self._conns:
-            raise HTTPException(404, "SNMP connection not found")
-
-        _logger.debug("set conn=%r object=%r value=%r", conn_id, obj_id,
-                      value)
+    async def _walk(self, conn_id: str, table: tuple[str, ...]) \
+            -> dict[str, str]:
+        auth_data, _ = await self._get_target(conn_id)
+        engine = self._get_engine()
         try:
-            engine_error, pdu_error, _, results = await setCmd(
-                SnmpEngine(),
-                self._get_auth_data(self._conns[conn_id]),
-                self._get_transport(self._conns[conn_id]),
-                ContextData(),
-                ObjectType(obj_id, value),
-            )
-            if engine_error:
-                _logger.error("Engine Error: %r", engine_error)
-                raise HTTPException(500, f"SNMP Engine error: {engine_error}")
+            root = ObjectIdentity(*table).resolveWithMib(
+                CommandGeneratorVarBinds.getMibViewController(engine),
+            ).getOid()
+        except PySnmpError as ex:
+            raise HTTPException(400, f"Invalid data id: {ex}") from ex
+        snmp_v1 = isinstance(auth_data, CommunityData) \
+            and auth_data.mpModel == 0
+        rows: dict[str, str] = {}
+        oid: ObjectName = root
+        while True:
+            _logger.debug("SNMP walk conn=%r object=%r", conn_id, oid)
+            if snmp_v1:
+                pdu_error, _, var_bind_table = await self._command(
+                    conn_id, nextCmd, ObjectType(ObjectIdentity(oid)),
+                )
+            else:
+                pdu_error, _, var_bind_table = await self._command(
+                    conn_id, bulkCmd, 0,
+                    self._conns[conn_id].max_repetitions,
+                    ObjectType(ObjectIdentity(oid)),
+                )
             if pdu_error:
-                _logger.error("Pdu Error: %r", pdu_error)
+                if snmp_v1 and pdu_error.prettyPrint() == "noSuchName":
+                    # SNMPv1 agents report end of the MIB view as an error
+                    return rows
                 raise HTTPException(500, f"SNMP Pdu error: {pdu_error}")
+            if not var_bind_table:
+                return rows
+            for row in var_bind_table:
+                for var_bind in row:
+                    name = var_bind[0].getOid()
+                    if not root.isPrefixOf(name) or name <= oid \
+                            or isinstance(var_bind[1], EndOfMibView):
+                        return rows
+                    rows[".".join(map(str, name[len(root):]))] = \
+                        var_bind[1].prettyPrint()
+                    oid = name
+
+    async def _get_walk(self, conn_id: str, table: tuple[str, ...]) \
+            -> dict[str, str]:
+        key = (conn_id, table)
+        if key not in self._walks:
+            task = asyncio.create_task(self._walk(conn_id, table))
+            self._walks[key] = task
+            task.add_done_callback(lambda _: self._walks.pop(key, None))
+        return await asyncio.shield(self._walks[key])
+
+    async def _get_walk_value(self, conn_id: str, table: tuple[str, ...],
+                              index: str | None) -> str | list[str]:
+        rows = await self._get_walk(conn_id, table)
+        if index is None:
+            return list(rows.values())
+        return rows.get(index, _NO_SUCH_INSTANCE)
+
+    async def get_value(self, data_id: str) -> str | list[str]:
+        handle = self._data_ids.get(data_id)
+        if handle.table is not None:
+            return await self._get_walk_value(handle.conn_id, handle.table,
+                                              handle.index)
+        conn_id, obj_id = handle.conn_id, handle.obj_id
+
+        _logger.debug("SNMP get conn=%r object=%r", conn_id, obj_id)
+        pdu_error, _, results = await self._command(conn_id, getCmd,
+                                                    ObjectType(obj_id))
+        if pdu_error:
+            raise HTTPException(500, f"SNMP Pdu error: {pdu_error}")
+        if len(results) == 1:
             return results[0][1].prettyPrint()
-        except PySnmpError as ex:
-            _logger.error("Error: %r", ex)
-            raise HTTPException(500, f"SNMP error: {ex}") from ex
+        return list(map(lambda result: result[1].prettyPrint(), results))
+
+    async def _get_batch(self, conn_id: str,
+                         batch: list[tuple[str, ObjectIdentity]]) \
+            -> dict[str, str | list[str]]:
+        _logger.debug("SNMP get conn=%r objects=%r", conn_id, len(batch))
+        pdu_error, error_index, results = await self._command(
+            conn_id, getCmd, *(ObjectType(obj_id) for _, obj_id in batch),
+        )
+        if pdu_error:
+            if pdu_error.prettyPrint() == "tooBig" and len(batch) > 1:
+                _logger.debug("SNMP response too big for %r objects, "
+                              "splitting", len(batch))
+                half = len(batch) // 2
+                first, second = await asyncio.gather(
+                    self._get_batch(conn_id, batch[:half]),
+                    self._get_batch(conn_id, batch[half:]),
+                )
+                first.update(second)
+                return first
+            failed = int(error_index) - 1
+            if not 0 <= failed < len(batch):
+                raise HTTPException(500, f"SNMP Pdu error: {pdu_error}")
+            # Error is reported for a single object, get the rest again
+            result: dict[str, str | list[str]] = {
+                batch[failed][0]: f"SNMP Pdu error: {pdu_error}",
+            }
+            if len(batch) > 1:
+                result.update(await self._get_batch(
+                    conn_id, batch[:failed] + batch[failed + 1:],
+                ))
+            return result
+        return {data_id: var_bind[1].prettyPrint()
+                for (data_id, _), var_bind in zip(batch, results)}
+
+    async def get_value_multiple(self, data_ids: Iterable[str]) \
+            -> dict[str, str | list[str]]:
+        requests: dict[str, list[tuple[str, ObjectIdentity]]] = {}
+        walks: dict[str, tuple[str, tuple[str, ...], str | None]] = {}
+        for data_id in dict.fromkeys(data_ids):
+            handle = self._data_ids.get(data_id)
+            if handle.table is not None:
+                walks[data_id] = (handle.conn_id, handle.table, handle.index)
+                continue
+            if handle.conn_id not in self._conns:
+                raise HTTPException(404, "SNMP connection not found")
+            if handle.conn_id not in requests:
+                requests[handle.conn_id] = []
+            requests[handle.conn_id].append((data_id, handle.obj_id))
+
+        batches: list[tuple[str, list[tuple[str, ObjectIdentity]]]] = []
+        for conn_id, objects in requests.items():
+            max_varbinds = max(self._conns[conn_id].max_varbinds, 1)
+            batches.extend((conn_id, objects[i:i + max_varbinds])
+                           for i in range(0, len(objects), max_varbinds))
+
+        async def get_batch(conn_id: str,
+                            batch: list[tuple[str, ObjectIdentity]]) \
+                -> dict[str, str | list[str]]:
+            try:
+                return await self._get_batch(conn_id, batch)
+            except DeviceUnavailable:
+                return unavailable(data_id for data_id, _ in batch)
+
+        async def get_walk(data_id: str, conn_id: str,
+                           table: tuple[str, ...], index: str | None) \
+                -> dict[str, str | list[str]]:
+            try:
+                return {data_id: await self._get_walk_value(conn_id, table,
+                                                            index)}
+            except DeviceUnavailable:
+                return unavailable((data_id,))
+
+        result: dict[str, str | list[str]] = {}
+        for values in await asyncio.gather(
+            *(get_batch(conn_id, batch) for conn_id, batch in batches),
+            *(get_walk(data_id, *walk) for data_id, walk in walks.items()),
+        ):
+            result.update(values)
+        return result
+
+    async def set_value(self, data_id: str, value: str) -> str | None:
+        handle = self._data_ids.get(data_id)
+        if handle.table is not None:
+            raise HTTPException(400, "Cannot write table data id")
+        conn_id, obj_id = handle.conn_id, handle.obj_id
+
+        _logger.debug("set conn=%r object=%r value=%r", conn_id, obj_id,
+                      value)
+        pdu_error, _, results = await self._command(
+            conn_id, setCmd, ObjectType(obj_id, value),
+        )
+        if pdu_error:
+            _logger.error("Pdu Error: %r", pdu_error)
+            raise HTTPException(500, f"SNMP Pdu error: {pdu_error}")
+        return results[0][1].prettyPrint()
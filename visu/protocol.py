@@ -0,0 +1,34 @@
+"""Binary protocol of scheme WebSockets"""
+import struct
+from typing import Iterable
+
+
+# WebSocket subprotocol requested by clients which accept binary updates
+BINARY_SUBPROTOCOL = "visu.binary"
+
+# Handles of points and SVG elements are sent as unsigned shorts
+MAX_HANDLES = 1 << 16
+
+_DELTA_STYLE = 0
+_DELTA_TEXT = 1
+
+# handle, delta type, value length
+_ENTRY = struct.Struct("!HBI")
+
+
+def encode_deltas(deltas: Iterable[tuple[int, str | None, str | None]]) \
+        -> bytes:
+    """
+    Encodes (SVG element handle, style, text) deltas into a binary frame.
+    Each changed style attribute or text is an entry of the header packed as
+    _ENTRY followed by the UTF-8 encoded value.
+    """
+    parts: list[bytes] = []
+    for handle, style, text in deltas:
+        for delta_type, value in ((_DELTA_STYLE, style), (_DELTA_TEXT, text)):
+            if value is None:
+                continue
+            data = value.encode()
+            parts.append(_ENTRY.pack(handle, delta_type, len(data)))
+            parts.append(data)
+    return b"".join(parts)
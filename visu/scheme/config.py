@@ -1,9 +1,12 @@
 from dataclasses import field
 from enum import Enum
+from functools import cached_property
 import re
 
 from tomlconfig import configclass
 
+from .style import StyleMatcher
+
 
 class ElementType(Enum):
     TEXT = 'text'
@@ -48,6 +51,7 @@ class ElementConfig:
     cov: bool = False
     single: bool = False
     influx_query: str = ""
+    max_age: float | None = None
 
     type: ElementType = ElementType.TEXT
     match: str | None = None
@@ -60,9 +64,12 @@ class ElementConfig:
     style: tuple[ElementStyleConfig, ...] = \
         field(default_factory=lambda: (ElementStyleConfig(),))
 
+    @cached_property
+    def style_matcher(self) -> StyleMatcher:
+        return StyleMatcher(self.style)
+
     def get_style_match(self, value: str) -> ElementStyleConfig | None:
-        return next((style for style in self.style
-                     if style.value_matches(value)), None)
+        return self.style_matcher.match(value)
 
 
 @configclass
@@ -83,5 +90,6 @@ class SchemeConfig:
     scheme_id: str = ""
     svg_path: str = ""
     interval: int = 5
+    deadline: float | None = None
     element: list[ElementConfig] = field(default_factory=list)
     group: list[ElementGroupConfig] = field(default_factory=list)
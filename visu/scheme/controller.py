@@ -1,9 +1,11 @@
 """Schemes module of the visu application"""
 import asyncio
+from dataclasses import dataclass
+from itertools import count
 import logging
+from secrets import token_urlsafe
 from typing import Iterable
 from xml.etree import ElementTree as etree
-from xml.etree.ElementTree import Element, ElementTree
 
 from fastapi.exceptions import HTTPException
 
@@ -11,6 +13,7 @@ from tomlconfig import ConfigError, configclass_attrs_set
 
 from ..config import Config
 from ..data.controller import DataController
+from ..data.health import UNAVAILABLE
 from .config import (
     ElementConfig,
     ElementGroupTemplateConfig,
@@ -18,10 +21,26 @@ from .config import (
     ElementType,
     SchemeConfig,
 )
+from .svg import SVGRender, SVGTemplate
 
 
 _logger = logging.getLogger(__name__)
 
+# Style attribute and text of an SVG element, empty if the element has none
+Delta = tuple[str, str]
+
+# Style of elements showing values of unavailable devices
+_UNAVAILABLE_STYLE = ElementStyleConfig(opacity=0.5, text="%%")
+
+
+@dataclass
+class RenderedScheme:
+    """SVG of a scheme and data ids of modules not loaded in time"""
+    svg: str
+    pending: dict[str, list[str]]
+    # Changes only when the SVG or pending data ids change
+    etag: str
+
 
 class SchemesController:
     """Class for managing schemes"""
@@ -50,9 +69,34 @@ class SchemesController:
             if scheme.scheme_id in self._schemes:
                 raise ConfigError(f"Duplicate scheme id {scheme.scheme_id}")
             self._schemes[scheme.scheme_id] = scheme
+        self._svgs: dict[str, SVGTemplate] = {}
+        self._rendered: dict[str, tuple[SVGRender, RenderedScheme]] = {}
+        # Distinguishes ETags of renders from before a restart
+        self._etag_prefix = token_urlsafe(6)
+        self._versions = count(1)
+        # Last known values of points of each scheme, see render_deltas
+        self._values: dict[str, dict[tuple[str, str], str]] = {
+            scheme_id: {} for scheme_id in self._schemes
+        }
+        # Last delta of each SVG element with the values it was built from
+        self._deltas: dict[tuple[str, str],
+                           tuple[SVGTemplate, tuple[str | None, ...],
+                                 Delta]] = {}
 
         self._resolve_groups()
         self._resolve_templates()
+        self._compile_styles()
+        self._bound: dict[str, dict[tuple[str, str], list[ElementConfig]]] = {
+            scheme.scheme_id: {} for scheme in self._schemes.values()
+        }
+        for scheme in self._schemes.values():
+            for element in scheme.element:
+                self._bound[scheme.scheme_id].setdefault(
+                    (element.data_module, element.data_id), [],
+                ).append(element)
+        # Elements changing the slots of each SVG element, see render_deltas
+        self._slot_elements: dict[tuple[str, str],
+                                  tuple[SVGTemplate, list[ElementConfig]]] = {}
         _logger.debug("Discovered groups: %r", self._groups.keys())
         _logger.debug("Discovered templates: %r", self._templates.keys())
         _logger.debug("Discovered schemes: %r", self._schemes.keys())
@@ -98,6 +142,7 @@ class SchemesController:
         new_element.influx_query = self._str_resolve_variables(
             element.influx_query, variables,
         )
+        new_element.max_age = element.max_age
 
         new_element.type = element.type
         new_element.match = None if element.match is None else \
@@ -146,6 +191,12 @@ class SchemesController:
                     if attr not in explicit_attrs:
                         setattr(element, attr, getattr(template, attr))
 
+    def _compile_styles(self) -> None:
+        # Styles of elements do not change once templates are resolved
+        for scheme in self._schemes.values():
+            for element in scheme.element:
+                element.style_matcher
+
     def get_schemes(self) -> Iterable[SchemeConfig]:
         """Returns a list of configured schemes"""
         return self._schemes.values()
@@ -181,33 +232,45 @@ class SchemesController:
             aggregated[element.data_module].append(element)
         return aggregated
 
-    def _apply_style(self, svg_element: Element,
+    def _apply_style(self, render: SVGRender, slots: tuple[int, int],
                      element_style: ElementStyleConfig, value: str) -> None:
-        prev_style = svg_element.attrib.get("style", "")
+        style_slot, text_slot = slots
+        prev_style = render.get(style_slot) or ""
         if element_style.fill is not None:
-            svg_element.attrib["style"] = \
-                f"{prev_style};fill:{element_style.fill}"
+            render.set(style_slot, f"{prev_style};fill:{element_style.fill}")
         if element_style.opacity is not None:
-            svg_element.attrib["style"] = \
-                f"{prev_style};opacity:{element_style.opacity}"
+            render.set(style_slot,
+                       f"{prev_style};opacity:{element_style.opacity}")
         if element_style.style is not None:
-            svg_element.attrib["style"] = element_style.style
+            render.set(style_slot, element_style.style)
         if element_style.text is not None:
-            children = list(svg_element)
-            if len(children) > 0:
-                children[0].text = element_style.text.replace("%%", value)
-            else:
-                svg_element.text = element_style.text.replace("%%", value)
+            render.set(text_slot, element_style.text.replace("%%", value))
+
+    def _get_svg(self, scheme: SchemeConfig) -> SVGTemplate:
+        svg = self._svgs.get(scheme.scheme_id)
+        try:
+            if svg is None or svg.changed():
+                svg = SVGTemplate(f"{self.schemes_dir}/{scheme.svg_path}",
+                                  (element.svg_id
+                                   for element in scheme.element))
+                self._svgs[scheme.scheme_id] = svg
+                _logger.debug("Loaded SVG of scheme %r", scheme.scheme_id)
+        except OSError as ex:
+            self._svgs.pop(scheme.scheme_id, None)
+            raise HTTPException(500, "Could not load scheme SVG") from ex
+        return svg
 
-    def _build_element(self, svg: ElementTree, element: ElementConfig,
+    def _build_element(self, render: SVGRender, element: ElementConfig,
                        data: str, scheme_id: str) -> None:
-        svg_elements = svg.findall(f"//*[@id='{element.svg_id}']")
-        if not svg_elements:
+        slots = render.template.elements.get(element.svg_id)
+        if slots is None:
             _logger.error("Could not find '%r' in the SVG of scheme '%r'",
                           element.svg_id, scheme_id)
             return
-        svg_element = svg_elements[0]
 
+        if data == UNAVAILABLE:
+            self._apply_style(render, slots, _UNAVAILABLE_STYLE, data)
+            return
         element_style = element.get_style_match(data)
         if element_style is None:
             _logger.error("No style match for value '%r' in element %r in "
@@ -220,14 +283,21 @@ class SchemesController:
                 _logger.error("Expected float value for %r in %r: %r",
                               element.svg_id, scheme_id, ex)
                 return
-        self._apply_style(svg_element, element_style,
+        self._apply_style(render, slots, element_style,
                           element.map.get(data, data))
 
-    async def build_svg(self, scheme_id: str,
-                        data_controller: DataController) -> str:
+    async def render_scheme(self, scheme_id: str,
+                            data_controller: DataController,
+                            deadline: float | None) -> RenderedScheme:
         """
-        Builds the final SVG of scheme with scheme_id SVG XML using values
-        retrieved from data_controller.
+        Builds the final SVG of scheme with scheme_id using values retrieved
+        from data_controller, reusing the previous render if no value in the
+        SVG has changed since.
+
+        If deadline is not None, waits at most deadline seconds for the
+        values of each data module. Modules which do not respond in time are
+        rendered with their last known values and their data ids are
+        returned as pending.
 
         Raises:
         - HTTPException(404) if the scheme_id is not found
@@ -236,26 +306,112 @@ class SchemesController:
         if scheme_id not in self._schemes:
             raise HTTPException(404, "Scheme not found")
         scheme = self._schemes[scheme_id]
-        try:
-            svg = etree.parse(f"{self.schemes_dir}/{scheme.svg_path}")
-        except OSError as ex:
-            raise HTTPException(500, "Could not load scheme SVG") from ex
+        self._get_svg(scheme)
         aggr_elements = self._aggregate_elements(scheme.element)
 
-        data_tasks = map(lambda data_module:
-                         data_controller.get_values(data_module, map(
-                             lambda element: element.data_id,
-                             aggr_elements[data_module],
-                         )),
-                         aggr_elements.keys())
-
-        data = await asyncio.gather(*data_tasks)
-        for elements, elements_data in zip(aggr_elements.values(), data):
+        data_tasks = {
+            data_module: asyncio.ensure_future(data_controller.get_values(
+                data_module, map(lambda element: element.data_id, elements),
+            ))
+            for data_module, elements in aggr_elements.items()
+        }
+        pending: dict[str, list[str]] = {}
+        if deadline is None:
+            await asyncio.gather(*data_tasks.values())
+        elif data_tasks:
+            await asyncio.wait(data_tasks.values(), timeout=deadline)
+
+        # The file may have changed while waiting for the data
+        render = self._get_svg(scheme).render()
+        for data_module, elements in aggr_elements.items():
+            task = data_tasks[data_module]
+            if task.done():
+                elements_data = task.result()
+            else:
+                # Fetches are shared, the values are loaded by the client
+                # when the fetch completes
+                task.cancel()
+                pending[data_module] = [element.data_id
+                                        for element in elements]
+                elements_data = data_controller.cache.peek(
+                    data_module, pending[data_module],
+                )
             for element in elements:
-                self._build_element(svg, element,
-                                    str(elements_data[element.data_id]),
-                                    scheme_id)
+                if element.data_id in elements_data:
+                    value = str(elements_data[element.data_id])
+                    self._values[scheme_id][(data_module,
+                                             element.data_id)] = value
+                    self._build_element(render, element, value, scheme_id)
+
+        if scheme_id in self._rendered:
+            prev_render, rendered = self._rendered[scheme_id]
+            if prev_render.template is render.template \
+                    and prev_render.values == render.values \
+                    and rendered.pending == pending:
+                return rendered
+        rendered = RenderedScheme(
+            render.result(), pending,
+            f'"{self._etag_prefix}-{next(self._versions)}"',
+        )
+        self._rendered[scheme_id] = (render, rendered)
+        return rendered
 
-        svg.getroot().attrib["width"] = "100%"
-        svg.getroot().attrib["height"] = "100%"
-        return etree.tostring(svg.getroot(), encoding="unicode")
+    def _get_slot_elements(self, scheme: SchemeConfig, svg: SVGTemplate,
+                           svg_id: str) -> list[ElementConfig]:
+        """
+        Returns elements of the scheme changing the style or text of svg_id
+        in the order of the scheme, which includes elements with the same
+        svg_id and the elements with a child of svg_id whose text is set
+        """
+        key = (scheme.scheme_id, svg_id)
+        if key in self._slot_elements and self._slot_elements[key][0] is svg:
+            return self._slot_elements[key][1]
+        slots = set(svg.elements[svg_id])
+        elements = [element for element in scheme.element
+                    if element.svg_id in svg.elements
+                    and slots.intersection(svg.elements[element.svg_id])]
+        self._slot_elements[key] = (svg, elements)
+        return elements
+
+    def render_deltas(self, scheme_id: str, data_module: str, data_id: str,
+                      value: str) -> dict[str, Delta]:
+        """
+        Returns the style attributes and texts of the SVG elements of the
+        scheme showing data_id of data_module after it changes to value, the
+        same as in a render by render_scheme with the last known values of
+        the other points shown by the elements. Elements are applied in the
+        order of the scheme, so later ones override the earlier ones. Deltas
+        are computed once for each new combination of values.
+
+        Text is set on the first child of elements with children.
+        """
+        scheme = self.get_scheme(scheme_id)
+        svg = self._svgs.get(scheme_id)
+        if svg is None:
+            svg = self._get_svg(scheme)
+        values = self._values[scheme_id]
+        values[(data_module, data_id)] = value
+
+        deltas: dict[str, Delta] = {}
+        for element in self._bound[scheme_id].get((data_module, data_id), []):
+            svg_id = element.svg_id
+            if svg_id in deltas or svg_id not in svg.elements:
+                continue
+            key = (scheme_id, svg_id)
+            elements = self._get_slot_elements(scheme, svg, svg_id)
+            inputs = tuple(values.get((other.data_module, other.data_id))
+                           for other in elements)
+            if key in self._deltas and self._deltas[key][0] is svg \
+                    and self._deltas[key][1] == inputs:
+                deltas[svg_id] = self._deltas[key][2]
+                continue
+            render = svg.render()
+            for other, other_value in zip(elements, inputs):
+                if other_value is not None:
+                    self._build_element(render, other, other_value,
+                                        scheme_id)
+            style_slot, text_slot = svg.elements[svg_id]
+            deltas[svg_id] = (render.get(style_slot) or "",
+                              render.get(text_slot) or "")
+            self._deltas[key] = (svg, inputs, deltas[svg_id])
+        return deltas
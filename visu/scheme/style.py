@@ -0,0 +1,135 @@
+"""Matching of values to element styles"""
+from bisect import bisect_left
+from math import inf, nextafter
+import re
+from typing import TYPE_CHECKING, Callable, Sequence
+
+if TYPE_CHECKING:
+    from .config import ElementStyleConfig
+
+
+_MEMO_SIZE = 64
+
+_LITERAL_RE = re.compile(r"[^.^$*+?{}\[\]\\|()]*")
+_ALWAYS_PATTERNS = ("", ".*", "^", "^.*")
+
+
+class _Checks:
+    """
+    Pattern matching part of a style list, only the styles in indices are
+    considered
+    """
+
+    def __init__(self, styles: Sequence["ElementStyleConfig"],
+                 indices: Sequence[int]) -> None:
+        # Index of the first style matching all values
+        self.default = len(styles)
+        # Styles with ^literal$ patterns by the matching value
+        self.exact: dict[str, int] = {}
+        self.searches: list[tuple[int, Callable[[str], object]]] = []
+        for index in indices:
+            pattern = styles[index].match
+            if pattern is None:
+                continue
+            if pattern in _ALWAYS_PATTERNS:
+                self.default = index
+                break
+            literal = pattern[1:-1]
+            if pattern.startswith("^") and pattern.endswith("$") \
+                    and _LITERAL_RE.fullmatch(literal):
+                # $ also matches before a trailing newline
+                self.exact.setdefault(literal, index)
+                self.exact.setdefault(f"{literal}\n", index)
+            elif _LITERAL_RE.fullmatch(pattern):
+                self.searches.append((index, _contains(pattern)))
+            else:
+                self.searches.append((index, re.compile(pattern).search))
+
+    def first(self, value: str, best: int) -> int:
+        """Returns the first matching style before best, or best"""
+        best = min(best, self.default, self.exact.get(value, best))
+        for index, search in self.searches:
+            if index >= best:
+                break
+            if search(value):
+                return index
+        return best
+
+
+def _contains(literal: str) -> Callable[[str], bool]:
+    return lambda value: literal in value
+
+
+class StyleMatcher:
+    """
+    Returns the first style matching a value, as trying
+    ElementStyleConfig.value_matches on each style would, using compiled
+    patterns and a table of the numeric ranges of styles.
+    """
+
+    def __init__(self, styles: Sequence["ElementStyleConfig"]) -> None:
+        self.styles = tuple(styles)
+        ranged = [index for index, style in enumerate(self.styles)
+                  if style.min is not None or style.max is not None]
+        self._nan = ranged[0] if ranged else len(self.styles)
+        # Numbers are matched by range in ranged styles and by pattern in
+        # the others, other values are matched by pattern in all styles
+        self._text_checks = _Checks(self.styles, range(len(self.styles)))
+        self._num_checks = _Checks(
+            self.styles,
+            sorted(set(range(len(self.styles))).difference(ranged)),
+        )
+
+        # Sorted bounds of all ranges, region 2 * i + 1 is the bound i and
+        # region 2 * i is between the bounds i - 1 and i
+        self._bounds = sorted({bound for index in ranged
+                               for bound in (self.styles[index].min,
+                                             self.styles[index].max)
+                               if bound is not None})
+        self._regions: list[int] = []
+        below = -inf
+        for bound in self._bounds:
+            # Any number between two bounds represents the whole region
+            self._regions.append(self._first_in_range(nextafter(bound, below),
+                                                      ranged))
+            self._regions.append(self._first_in_range(bound, ranged))
+            below = bound
+        self._regions.append(self._first_in_range(nextafter(below, inf),
+                                                  ranged))
+
+        self._memo: dict[str, "ElementStyleConfig | None"] = {}
+
+    def _first_in_range(self, value: float, ranged: list[int]) -> int:
+        for index in ranged:
+            style = self.styles[index]
+            if (style.min is None or style.min <= value) \
+                    and (style.max is None or value <= style.max):
+                return index
+        return len(self.styles)
+
+    def _match(self, value: str) -> "ElementStyleConfig | None":
+        try:
+            num_value = float(value)
+        except ValueError:
+            index = self._text_checks.first(value, len(self.styles))
+        else:
+            if num_value != num_value:
+                # NaN is not outside of any range
+                best = self._nan
+            else:
+                i = bisect_left(self._bounds, num_value)
+                if i < len(self._bounds) and self._bounds[i] == num_value:
+                    best = self._regions[2 * i + 1]
+                else:
+                    best = self._regions[2 * i]
+            index = self._num_checks.first(value, best)
+        return self.styles[index] if index < len(self.styles) else None
+
+    def match(self, value: str) -> "ElementStyleConfig | None":
+        if value in self._memo:
+            return self._memo[value]
+        style = self._match(value)
+        if len(self._memo) >= _MEMO_SIZE:
+            del self._memo[next(iter(self._memo))]
+        self._memo[value] = style
+        return style
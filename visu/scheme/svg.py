@@ -0,0 +1,161 @@
+"""Render plans of scheme SVGs"""
+import os
+import re
+from typing import Callable, Iterable
+from xml.etree import ElementTree as etree
+from xml.etree.ElementTree import Element
+
+
+_MARKER_RE = re.compile("\x00([0-9]+)\x00")
+
+
+def _marker(slot: int) -> str:
+    # NUL is not allowed in XML documents, so it cannot occur in the file
+    return f"\x00{slot}\x00"
+
+
+class _Slot:
+    """
+    Place in the serialized SVG whose content is replaced by a render.
+
+    A set value is written escaped between prefix and suffix, unset values
+    (None, or empty text) are written as empty.
+    """
+
+    __slots__ = ("prefix", "suffix", "empty", "escape", "is_text",
+                 "original", "serialized")
+
+    def __init__(self, prefix: str, suffix: str, empty: str,
+                 escape: Callable[[str], str], is_text: bool,
+                 original: str | None) -> None:
+        self.prefix = prefix
+        self.suffix = suffix
+        self.empty = empty
+        self.escape = escape
+        self.is_text = is_text
+        self.original = original
+        self.serialized = self.serialize(original)
+
+    def serialize(self, value: str | None) -> str:
+        if value is None or (self.is_text and not value):
+            return self.empty
+        return f"{self.prefix}{self.escape(value)}{self.suffix}"
+
+
+class SVGTemplate:
+    """
+    SVG file of a scheme serialized at load time into static segments with
+    slots for the style attributes and texts of the elements in svg_ids.
+
+    A render joins the segments with the serialized slot values, its output
+    is the same as serializing the tree modified with the values.
+    """
+
+    def __init__(self, path: str, svg_ids: Iterable[str]) -> None:
+        self.path = path
+        self._stat = self._file_stat()
+        root = etree.parse(path).getroot()
+        root.attrib["width"] = "100%"
+        root.attrib["height"] = "100%"
+
+        index: dict[str, Element] = {}
+        for element in root.iter():
+            svg_id = element.get("id")
+            if element is not root and svg_id is not None:
+                index.setdefault(svg_id, element)
+
+        # svg_id -> (style slot, text slot)
+        self.elements: dict[str, tuple[int, int]] = {}
+        slots: dict[tuple[int, bool], int] = {}
+        originals: list[tuple[Element, bool]] = []
+        for svg_id in svg_ids:
+            if svg_id in self.elements or svg_id not in index:
+                continue
+            element = index[svg_id]
+            # Text of elements with children is set on the first child
+            text_element = element[0] if len(element) > 0 else element
+            for target, is_text in ((element, False), (text_element, True)):
+                if (id(target), is_text) not in slots:
+                    slots[(id(target), is_text)] = len(originals)
+                    originals.append((target, is_text))
+            self.elements[svg_id] = (slots[(id(element), False)],
+                                     slots[(id(text_element), True)])
+
+        self._slots: list[_Slot] = []
+        for slot, (target, is_text) in enumerate(originals):
+            if is_text:
+                self._slots.append(_Slot("", "", "", etree._escape_cdata,
+                                         True, target.text))
+                target.text = _marker(slot)
+            else:
+                self._slots.append(_Slot("", "", "", etree._escape_attrib,
+                                         False, target.get("style")))
+                target.attrib["style"] = _marker(slot)
+
+        parts = _MARKER_RE.split(etree.tostring(root, encoding="unicode"))
+        self._segments = parts[::2]
+        # Number the slots in the order of the document
+        order = [int(slot) for slot in parts[1::2]]
+        renumber = {slot: position for position, slot in enumerate(order)}
+        self.elements = {
+            svg_id: (renumber[style_slot], renumber[text_slot])
+            for svg_id, (style_slot, text_slot) in self.elements.items()
+        }
+        self._slots = [self._slots[slot] for slot in order]
+        originals = [originals[slot] for slot in order]
+        for slot, (target, is_text) in enumerate(originals):
+            before, after = self._segments[slot], self._segments[slot + 1]
+            if not is_text and self._slots[slot].original is None:
+                # The attribute was added by the marker, it is written only
+                # when set
+                self._segments[slot] = before[:-len(' style="')]
+                self._segments[slot + 1] = after[1:]
+                self._slots[slot] = _Slot(' style="', '"', "",
+                                          etree._escape_attrib, False, None)
+            elif is_text and len(target) == 0:
+                # Elements without text and children are written as <tag />
+                close = after[:after.index(">") + 1]
+                self._segments[slot] = before[:-1]
+                self._segments[slot + 1] = after[len(close):]
+                self._slots[slot] = _Slot(">", close, " />",
+                                          etree._escape_cdata, True,
+                                          self._slots[slot].original)
+
+    def _file_stat(self) -> tuple[int, int]:
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def changed(self) -> bool:
+        """Returns True if the file was modified since it was loaded"""
+        return self._file_stat() != self._stat
+
+    def render(self) -> "SVGRender":
+        return SVGRender(self)
+
+
+class SVGRender:
+    """Values of the slots of a template set during a single render"""
+
+    def __init__(self, template: SVGTemplate) -> None:
+        self.template = template
+        self.values: dict[int, str] = {}
+
+    def get(self, slot: int) -> str | None:
+        if slot in self.values:
+            return self.values[slot]
+        return self.template._slots[slot].original
+
+    def set(self, slot: int, value: str) -> None:
+        self.values[slot] = value
+
+    def result(self) -> str:
+        segments = self.template._segments
+        slots = self.template._slots
+        parts = [segments[0]]
+        for slot in range(len(slots)):
+            if slot in self.values:
+                parts.append(slots[slot].serialize(self.values[slot]))
+            else:
+                parts.append(slots[slot].serialized)
+            parts.append(segments[slot + 1])
+        return "".join(parts)
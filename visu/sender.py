@@ -0,0 +1,179 @@
+"""Outbound queues of WebSocket connections"""
+import asyncio
+from collections import deque
+import logging
+from typing import Any, Callable, Generic, Hashable, Iterable, TypeVar
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+
+_logger = logging.getLogger(__name__)
+
+# Close code sent to clients which do not keep up with the updates
+_CLOSE_TRY_AGAIN_LATER = 1013
+
+_K = TypeVar("_K", bound=Hashable)
+
+Value = str | list[str] | None
+
+
+class SenderStats:
+    """Counters shared by the senders of all connections"""
+
+    def __init__(self) -> None:
+        self.senders: set["WebSocketSender[Any]"] = set()
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.disconnected = 0
+
+    def get_stats(self) -> dict[str, int]:
+        depths = [sender.depth for sender in self.senders]
+        return {
+            "connections": len(depths),
+            "pending": sum(depths),
+            "max_pending": max(depths, default=0),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "disconnected": self.disconnected,
+        }
+
+
+class WebSocketSender(Generic[_K]):
+    """
+    Outbound queue of a single WebSocket connection flushed by a writer
+    task, so producers of values never wait for the client.
+
+    Values are coalesced to the latest value of each key and encoded in
+    batches by format_values into JSON objects or binary messages. Clients
+    which do not accept a message within send_timeout seconds or let more
+    than max_messages other messages pile up are disconnected.
+    """
+
+    def __init__(self, websocket: WebSocket, stats: SenderStats,
+                 format_values: Callable[[dict[_K, Value]],
+                                         Iterable[dict[str, Any] | bytes]],
+                 send_timeout: float, max_messages: int) -> None:
+        self.websocket = websocket
+        self.stats = stats
+        self.format_values = format_values
+        self.send_timeout = send_timeout
+        self.max_messages = max_messages
+        self._values: dict[_K, Value] = {}
+        self._messages: deque[dict[str, Any]] = deque()
+        self._ready = asyncio.Event()
+        self._closed = asyncio.Event()
+        self._writer: asyncio.Task[None] | None = None
+        self._close_task: asyncio.Task[None] | None = None
+
+    @property
+    def depth(self) -> int:
+        return len(self._values) + len(self._messages)
+
+    def start(self) -> None:
+        self.stats.senders.add(self)
+        self._writer = asyncio.create_task(self._write_loop())
+
+    async def stop(self) -> None:
+        self.stats.senders.discard(self)
+        self.stats.dropped += self.depth
+        self._values.clear()
+        self._messages.clear()
+        if self._writer is not None:
+            self._writer.cancel()
+            await asyncio.gather(self._writer, return_exceptions=True)
+            self._writer = None
+
+    def put_values(self, values: dict[_K, Value]) -> None:
+        if self._closed.is_set():
+            self.stats.dropped += len(values)
+            return
+        for key, value in values.items():
+            if key in self._values:
+                self.stats.coalesced += 1
+            self._values[key] = value
+        self._ready.set()
+
+    def put_message(self, message: dict[str, Any]) -> None:
+        if self._closed.is_set():
+            return
+        self._messages.append(message)
+        if len(self._messages) > self.max_messages:
+            _logger.warning("Disconnecting client %r, too many pending "
+                            "messages", self.websocket.client)
+            self._close()
+        self._ready.set()
+
+    async def receive_json(self) -> Any:
+        """
+        Receives a message from the client.
+
+        Raises WebSocketDisconnect if the client disconnects or is
+        disconnected by the sender.
+        """
+        receive = asyncio.ensure_future(self.websocket.receive_json())
+        closed = asyncio.ensure_future(self._closed.wait())
+        try:
+            done, _ = await asyncio.wait((receive, closed),
+                                         return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            receive.cancel()
+            closed.cancel()
+            raise
+        closed.cancel()
+        if receive not in done:
+            receive.cancel()
+            raise WebSocketDisconnect(_CLOSE_TRY_AGAIN_LATER)
+        return receive.result()
+
+    def _close(self) -> None:
+        if self._closed.is_set():
+            return
+        self.stats.disconnected += 1
+        self._closed.set()
+        self._close_task = asyncio.create_task(self._send_close())
+
+    async def _send_close(self) -> None:
+        try:
+            await asyncio.wait_for(
+                self.websocket.close(_CLOSE_TRY_AGAIN_LATER),
+                self.send_timeout,
+            )
+        except Exception as ex:
+            _logger.debug("Could not close WebSocket %r: %r",
+                          self.websocket.client, ex)
+
+    async def _send(self, message: dict[str, Any] | bytes) -> None:
+        if isinstance(message, bytes):
+            await self.websocket.send_bytes(message)
+        else:
+            await self.websocket.send_json(message)
+        self.stats.sent += 1
+
+    async def _write_loop(self) -> None:
+        while not self._closed.is_set():
+            await self._ready.wait()
+            self._ready.clear()
+            messages: list[dict[str, Any] | bytes] = list(self._messages)
+            self._messages.clear()
+            values = self._values
+            self._values = {}
+            if values:
+                try:
+                    messages.extend(self.format_values(values))
+                except Exception:
+                    _logger.exception("Could not format values %r", values)
+            try:
+                for message in messages:
+                    await asyncio.wait_for(self._send(message),
+                                           self.send_timeout)
+            except asyncio.TimeoutError:
+                _logger.warning("Disconnecting client %r, sending timed out",
+                                self.websocket.client)
+                self._close()
+            except Exception as ex:
+                # The connection is closed, the receiving side handles it
+                _logger.debug("Could not send to WebSocket %r: %r",
+                              self.websocket.client, ex)
+                self._closed.set()
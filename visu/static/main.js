@@ -110,7 +110,11 @@ const UpdateForm = ({ element, socket }) => {
                 key: "submit",
                 disabled: !!valueError,
                 onClick: () => {
-                    socket.send(JSON.stringify({ command: "set", data: { [element.data_id]: value }}));
+                    socket.send(JSON.stringify({
+                        command: "set",
+                        data_module: element.data_module,
+                        data: { [element.data_id]: value },
+                    }));
                     setValue(element.enum && element.enum.length ? element.enum[0] : "");
                 },
             },
@@ -176,67 +180,107 @@ const showMenu = (element, socket) => {
 };
 
 
-const aggregateElements = (elements)  => {
-    aggregated = { };
-    for (const element of elements) {
-        if (!aggregated[element.data_module])
-            aggregated[element.data_module] = [];
-        aggregated[element.data_module].push(element);
+const BINARY_SUBPROTOCOL = "visu.binary";
+const DELTA_STYLE = 0;
+const DELTA_TEXT = 1;
+const textDecoder = new TextDecoder();
+
+// Maps ids to nodes of the scheme SVG, the first node with an id wins
+const buildNodeMap = () => {
+    const nodes = new Map();
+    for (const node of document.querySelectorAll("#scheme svg [id]")) {
+        if (!nodes.has(node.id))
+            nodes.set(node.id, node);
+    }
+    return nodes;
+};
+
+// Deltas computed by the server applied once per animation frame
+const pendingDeltas = new Map();
+let deltasScheduled = false;
+
+const applyDeltas = () => {
+    deltasScheduled = false;
+    for (const [node, delta] of pendingDeltas) {
+        if (delta.style !== undefined)
+            node.setAttribute("style", delta.style);
+        if (delta.text !== undefined)
+            (node.firstElementChild ?? node).textContent = delta.text;
+    }
+    pendingDeltas.clear();
+};
+
+// Decodes (handle, type, value) deltas of a binary message, see
+// visu/protocol.py
+const decodeDeltas = (buffer, elementNodes) => {
+    const view = new DataView(buffer);
+    let offset = 0;
+    while (offset < view.byteLength) {
+        const handle = view.getUint16(offset);
+        const deltaType = view.getUint8(offset + 2);
+        const length = view.getUint32(offset + 3);
+        offset += 7;
+        const value = textDecoder.decode(new Uint8Array(buffer, offset, length));
+        offset += length;
+        const node = elementNodes[handle];
+        if (!node)
+            continue;
+        if (!pendingDeltas.has(node))
+            pendingDeltas.set(node, {});
+        pendingDeltas.get(node)[deltaType === DELTA_STYLE ? "style" : "text"] = value;
+    }
+    if (!deltasScheduled && pendingDeltas.size) {
+        deltasScheduled = true;
+        requestAnimationFrame(applyDeltas);
     }
-    return aggregated;
 };
 
 const initialize = () => {
-    const aggregated = aggregateElements(SCHEME_CONFIG.element);
-    for (const dataModule of Object.keys(aggregated)) {
-        const socket = new WebSocket(`${SOCKET_URL}/${dataModule}`);
-        socket.addEventListener(
-            "error",
-            (ev) => console.error(`Websocker error for ${dataModule}`, ev),
-        );
-        socket.addEventListener("message", (ev) => {
-            const msg = JSON.parse(ev.data);
-            if (msg.status) {
-                if (msg.status >= 400) {
-                    console.error(msg);
-                } else {
-                    console.log(msg);
-                }
+    const socket = new WebSocket(`${SOCKET_URL}/scheme/${SCHEME_CONFIG.scheme_id}`, [BINARY_SUBPROTOCOL]);
+    socket.binaryType = "arraybuffer";
+    const nodes = buildNodeMap();
+    let elementNodes = [];
+    socket.addEventListener(
+        "error",
+        (ev) => console.error(`Websocket error for ${SCHEME_CONFIG.scheme_id}`, ev),
+    );
+    socket.addEventListener("message", (ev) => {
+        if (ev.data instanceof ArrayBuffer) {
+            decodeDeltas(ev.data, elementNodes);
+            return;
+        }
+        const msg = JSON.parse(ev.data);
+        if (msg.status) {
+            if (msg.status >= 400) {
+                console.error(msg);
             } else {
-                for (const dataId in msg) {
-                    renderValue(dataModule, dataId, msg[dataId]);
-                }
+                console.log(msg);
             }
-        });
-        socket.addEventListener("open", () => {
-            const cov = aggregated[dataModule].filter((element) => element.cov);
-            const interval_aggregated = aggregated[dataModule].filter((element) => !element.cov && !element.single);
-            const interval_single = aggregated[dataModule].filter((element) => !element.cov && element.single);
+        } else if (msg.elements) {
+            elementNodes = msg.elements.map((svgId) => nodes.get(svgId));
+        } else {
+            for (const dataId in msg.data) {
+                renderValue(msg.data_module, dataId, msg.data[dataId]);
+            }
+        }
+    });
+    socket.addEventListener("open", () => {
+        // Subscriptions are created by the server from the scheme config
+        for (const dataModule of Object.keys(SCHEME_PENDING)) {
             socket.send(JSON.stringify({
-                command: "cov",
-                data_ids: cov.map((element) => element.data_id),
+                command: "get",
+                data_module: dataModule,
+                data_ids: SCHEME_PENDING[dataModule],
             }));
-            setInterval(() => {
-                socket.send(JSON.stringify({
-                    command: "get",
-                    data_ids: interval_aggregated.map((element) => element.data_id),
-                }));
-                for (const single_element of interval_single) {
-                    socket.send(JSON.stringify({
-                        command: "get",
-                        data_ids: single_element.data_id,
-                    }));
-                }
-            }, SCHEME_CONFIG.interval * 1000);
-        });
-
-        for (const element of aggregated[dataModule]) {
-            const svgElement = document.querySelector(`#scheme svg #${element.svg_id}`);
-            if (!svgElement)
-                continue;
-            svgElement.addEventListener("click", () => showMenu(element, socket));
-            svgElement.style.cursor = "pointer";
         }
+    });
+
+    for (const element of SCHEME_CONFIG.element) {
+        const svgElement = nodes.get(element.svg_id);
+        if (!svgElement)
+            continue;
+        svgElement.addEventListener("click", () => showMenu(element, socket));
+        svgElement.classList.add("scheme__element");
     }
 };
 